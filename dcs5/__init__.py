@@ -22,6 +22,9 @@ LOG_FILES_PATH = Path(LOCAL_FILE_PATH).joinpath("logs/")
 ### CONFIG PATH ###
 CONFIG_FILES_PATH = Path(LOCAL_FILE_PATH).joinpath("configs/")
 
+### BLUETOOTH PORT CACHE ###
+PORT_CACHE_FILE = Path(LOCAL_FILE_PATH).joinpath("port_cache.json")
+
 Path(LOCAL_FILE_PATH).mkdir(parents=True, exist_ok=True)
 LOG_FILES_PATH.mkdir(parents=True, exist_ok=True)
 CONFIG_FILES_PATH.mkdir(parents=True, exist_ok=True)
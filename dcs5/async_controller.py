@@ -0,0 +1,541 @@
+"""
+This module contains an asyncio version of the Dcs5Controller.
+
+The AsyncDcs5Controller does not start any thread. The RFCOMM socket is wrapped in asyncio streams,
+the `c_*` commands are coroutines that return once the board acknowledged them and the measurements
+and key events are read with `async for`:
+
+    controller = AsyncDcs5Controller(config_path, devices_specifications_path)
+    await controller.connect()
+    await controller.init_controller_and_board()
+    async for event in controller:
+        print(event.type, event.key, event.value)
+
+The `client/transport` of the configuration is used (see `create_client`). Bluetooth is connected natively,
+the other transports are connected in a thread and their connection is then moved to asyncio streams.
+
+Notes
+-----
+    Bluetooth sockets and serial devices are only supported by the selector event loop (default on Linux).
+"""
+import asyncio
+import logging
+import os
+import socket
+from collections import deque
+from dataclasses import dataclass
+from typing import *
+
+from dcs5.bluetooth_client import BluetoothClient, load_cached_port, cache_port
+from dcs5.transports import SerialClient, BOARD_MSG_ENCODING, BOARD_MSG_DELIMITER, BOARD_MSG_START, MAX_BUFFER_SIZE
+from dcs5 import protocol
+from dcs5.protocol import decode_board_message, LengthMeasurement, Swipe, ControlBoxKey, UsbPlugged, Reply
+from dcs5.controller import (
+    load_controller_configs, create_client, client_address, InternalBoardState, CommandHandler, rate_limited_log, reply_key, apply_launch_settings,
+    desired_board_state, set_board_setting, set_output_mode_settings, set_mode_key_backlight_pattern
+)
+from dcs5.logger import wire_logger, WIRE_LOGGING_LEVEL
+
+COMMAND_TIMEOUT = 5
+
+
+@dataclass
+class BoardEvent:
+    """
+    type :
+        One of `length`, `board_key` or `controller_box_key`.
+    key :
+        Board or control box key name. Measured length (mm) for `length`.
+    value :
+        Mapped output from the key maps.
+    """
+    type: str
+    key: Union[str, int]
+    value: Union[str, List[str]]
+
+
+class AsyncDcs5Controller:
+    min_port = BluetoothClient.min_port
+    max_port = BluetoothClient.max_port
+
+    def __init__(self, config_path: str, devices_specifications_path: str):
+        self.config_path = config_path
+        self.devices_specifications_path = devices_specifications_path
+        self.config, self.devices_specifications, self.control_box_parameters = load_controller_configs(
+            config_path, devices_specifications_path
+        )
+        self.key_tables = self.config.key_maps.compile(self.devices_specifications)
+
+        self.port: int = None
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._read_pipe: asyncio.ReadTransport = None  # Serial devices are read and written with separate pipes.
+        self._read_task: asyncio.Task = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._send_lock = asyncio.Lock()
+        self._pending_replies: Deque[Tuple[List[str], List[str], asyncio.Future]] = deque()
+        self._events: asyncio.Queue = asyncio.Queue()
+
+        self.internal_board_state = InternalBoardState()
+        self.is_sync = False
+        self.persistent_backlight_level: int = None
+
+        self.swipe_triggered = False
+        self.with_mode = False
+        self.last_key = None
+        self.last_command = None
+
+        # Used for the board replies parsing.
+        self.command_handler = CommandHandler(self)
+
+        self._set_board_settings()
+
+    def _set_board_settings(self):
+        apply_launch_settings(self)
+
+    @property
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self, timeout: float = 30):
+        """Connect to the board with the `client/transport` of the configuration."""
+        if self.config.client.transport == 'bluetooth':
+            await self._connect_bluetooth(timeout)
+        else:
+            await self._connect_transport(timeout)
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def _connect_transport(self, timeout: float):
+        """Connect the transport of the configuration in a thread and move its connection to asyncio streams."""
+        client = create_client(self.config.client)
+        try:
+            await asyncio.to_thread(
+                client.connect, client_address(self.config.client, self.devices_specifications), timeout=timeout
+            )
+            if not client.is_connected:
+                raise ConnectionError(f'Could not connect to {client.address}. {client.error_msg}')
+            fd = os.dup(client.socket.fileno())  # The client is shut down, the connection is kept by the copy.
+        finally:
+            client.shutdown()
+        self.port = client.port
+
+        if isinstance(client, SerialClient):
+            await self._open_serial_streams(fd)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(sock=socket.socket(fileno=fd), limit=MAX_BUFFER_SIZE)
+
+    async def _open_serial_streams(self, fd: int):
+        loop = asyncio.get_running_loop()
+        self._reader = asyncio.StreamReader(limit=MAX_BUFFER_SIZE)
+        self._read_pipe, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self._reader), os.fdopen(fd, 'rb', buffering=0)
+        )
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), os.fdopen(os.dup(fd), 'wb', buffering=0)
+        )
+        self._writer = asyncio.StreamWriter(transport, protocol, self._reader, loop)
+
+    async def _connect_bluetooth(self, timeout: float):
+        """The cached port is tried first, then all the ports are probed concurrently.
+
+        `timeout` is the deadline of the whole connection. The cached port attempt is capped to
+        `BluetoothClient.cached_port_timeout`.
+        """
+        mac_address = self.config.client.mac_address
+        logging.info(f'Attempting to connect to board. Timeout: {timeout} seconds')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        sock = None
+        if (port := load_cached_port(mac_address)) is not None:
+            logging.info(f'Trying cached port: {port}')
+            sock = await self._probe_port(mac_address, port, min(timeout, BluetoothClient.cached_port_timeout))
+
+        if sock is None and (remaining := deadline - loop.time()) > 0:
+            port, sock = await self._probe_all_ports(mac_address, remaining)
+
+        if sock is None:
+            raise ConnectionError(f'Could not connect to {mac_address}.')
+
+        self.port = port
+        cache_port(mac_address, port)
+        logging.info(f'Connected to port {self.port}')
+
+        self._reader, self._writer = await asyncio.open_connection(sock=sock, limit=MAX_BUFFER_SIZE)
+
+    @staticmethod
+    async def _probe_port(mac_address: str, port: int, timeout: float) -> Optional[socket.socket]:
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (mac_address, port)), timeout)
+            return sock
+        except (OSError, asyncio.TimeoutError) as err:
+            logging.debug(f'port {port}: {err!r}')
+        except asyncio.CancelledError:
+            sock.close()
+            raise
+        sock.close()
+        return None
+
+    async def _probe_all_ports(self, mac_address: str, timeout: float) -> Tuple[Optional[int], Optional[socket.socket]]:
+        """Probe all the ports concurrently. The first port to connect is kept and the other probes are cancelled."""
+        probes = {
+            asyncio.create_task(self._probe_port(mac_address, port, timeout)): port
+            for port in range(self.min_port, self.max_port + 1)
+        }
+        pending = set(probes)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if (sock := task.result()) is not None:
+                        return probes[task], sock
+        finally:
+            for task in pending:
+                task.cancel()
+        logging.error('No available ports were found.')
+        return None, None
+
+    async def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+        for task in self._tasks:
+            task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._on_disconnect()
+        logging.info('Client Closed.')
+
+    def _on_disconnect(self):
+        self.is_sync = False
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_pipe is not None:
+            self._read_pipe.close()
+        while self._pending_replies:
+            *_, future = self._pending_replies.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError('Connection to the board lost.'))
+        self._events.put_nowait(None)  # Ends the `async for` loops.
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> BoardEvent:
+        if (event := await self._events.get()) is None:
+            raise StopAsyncIteration
+        return event
+
+    async def _read_loop(self):
+        try:
+            while True:
+                try:
+                    frame = await self._reader.readuntil(BOARD_MSG_DELIMITER)
+                except asyncio.LimitOverrunError as err:  # Garbage. Discard it and resync on the next delimiter.
+                    logging.error(f'No message delimiter in {err.consumed} bytes received. Buffer discarded.')
+                    await self._reader.readexactly(err.consumed)
+                    continue
+                if (frame_start := frame.find(BOARD_MSG_START)) > 0:
+                    frame = frame[frame_start:]
+                if frame == BOARD_MSG_DELIMITER:
+                    continue
+                message = frame.decode(BOARD_MSG_ENCODING, errors='replace')
+                if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                    wire_logger.info('Received Message: %r', message)
+                self._process_board_message(message)
+        except (asyncio.IncompleteReadError, OSError) as err:
+            logging.error(f'Connection broken. {err!r}')
+            self._on_disconnect()
+
+    def _process_board_message(self, message: str):
+        board_message = decode_board_message(message)
+
+        if isinstance(board_message, Reply):
+            self._process_reply(board_message.value)
+
+        elif isinstance(board_message, Swipe):
+            if board_message.value > self.config.output_modes.swipe_threshold:
+                self.swipe_triggered = True
+
+        elif isinstance(board_message, LengthMeasurement):
+            if self.swipe_triggered is True:
+                self.swipe_triggered = False
+                if (mode := self.config.output_modes.find_segment_mode(board_message.value)) is not None:
+                    self._spawn(self.change_board_output_mode(mode))
+            else:
+                entry = self.key_tables.measurement_entry(
+                    self.output_mode, self.with_mode, board_message.value, self.stylus_offset, self.length_units
+                )
+                if entry is not None:
+                    self.last_key = entry.key
+                    self._process_output('length' if self.output_mode == 'length' else 'board_key', entry.key, entry.value)
+
+        elif isinstance(board_message, ControlBoxKey):
+            if (entry := self.key_tables.control_box_entry(self.with_mode, board_message.value)) is None:
+                rate_limited_log.error('unknown_key', 'Unknown control box key: %s', board_message.value)
+            else:
+                self.last_key = entry.key
+                self._process_output('controller_box_key', entry.key, entry.value)
+
+        elif isinstance(board_message, UsbPlugged):
+            logging.info('Usb Cabled plugged in.')
+
+    def _process_output(self, event_type: str, key: Union[str, int], value: Union[str, List[str]]):
+        """The `MODE` meta key is handled here. Every other output is put in the events queue."""
+        if value is None:
+            return
+        if value == "MODE":
+            self._set_with_mode(not self.with_mode)
+            return
+        self._set_with_mode(False)
+        self.last_command = value
+        self._events.put_nowait(BoardEvent(event_type, key, value))
+
+    def _set_with_mode(self, value: bool):
+        if value is not self.with_mode:
+            self.with_mode = value
+            self._spawn(self.set_mode_key_backlight_pattern(value))
+
+    def _spawn(self, coroutine: Coroutine):
+        """Run `coroutine` in a task. The event loop only keeps weak references to the tasks,
+        so they are kept in `_tasks` until done. Their exceptions are logged."""
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(self._log_task_exception)
+
+    @staticmethod
+    def _log_task_exception(task: asyncio.Task):
+        if not task.cancelled() and (err := task.exception()) is not None:
+            logging.error(f'{task.get_coro().__qualname__} failed. {err!r}')
+
+    def _process_reply(self, received: str):
+        """Match `received` with the oldest command waiting for a reply with the same key, preferring the
+        one expecting exactly this reply (see CommandHandler._match_reply). Unmatched replies are dropped.
+        """
+        self.command_handler.update_board_state(received)
+
+        key = reply_key(received)
+        pending = [entry for entry in self._pending_replies if reply_key(entry[0][len(entry[1])]) == key]
+        if not pending:
+            rate_limited_log.error('unexpected_reply', 'Unexpected: Command received: %r. No command pending.', received)
+            return
+        entry = next(
+            (e for e in pending if self.command_handler.is_expected(received, e[0][len(e[1])])), pending[0]
+        )
+
+        expected, replies, future = entry
+        if self.command_handler.is_expected(received, expected[len(replies)]):
+            if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                wire_logger.info('Command Valid. Received: %r', received)
+        else:
+            rate_limited_log.error(
+                'unexpected_reply', 'Unexpected: Command received: %r, Command expected: %r', received, expected[len(replies)]
+            )
+
+        replies.append(received)
+        if len(replies) == len(expected):
+            self._pending_replies.remove(entry)
+            if not future.done():
+                future.set_result(replies)
+
+    async def send_command(self, command: str, message: Union[str, List[str]] = None,
+                           timeout: float = COMMAND_TIMEOUT) -> List[str]:
+        """Send a command and wait for the expected reply(ies).
+
+        Returns the board replies. Raises asyncio.TimeoutError if the board does not reply in time.
+        """
+        if not self.is_connected:
+            raise ConnectionError('Board is not connected.')
+
+        expected = [] if message is None else message if isinstance(message, list) else [message]
+        future = asyncio.get_running_loop().create_future()
+        entry = (expected, [], future)
+
+        async with self._send_lock:
+            if expected:
+                self._pending_replies.append(entry)
+            else:
+                future.set_result([])
+            self._writer.write(command.encode(BOARD_MSG_ENCODING))
+            await self._writer.drain()
+            if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                wire_logger.info('Command Sent: %r', command)
+            await asyncio.sleep(self.control_box_parameters.min_command_interval)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f'Reply to {[command]} not received. Expected: {expected}')
+            if entry in self._pending_replies:
+                self._pending_replies.remove(entry)
+            raise
+
+    async def init_controller_and_board(self):
+        logging.info('Initializing Board.')
+        self.internal_board_state = InternalBoardState()
+        self.is_sync = False
+
+        desired = desired_board_state(self.config, self.output_mode)
+        for name, value in desired.items():
+            await set_board_setting(self, name, value)
+        await self.c_check_calibration_state()
+        await self.c_get_board_stats()
+        await self.c_ping()
+
+        self.is_sync = all(getattr(self.internal_board_state, name) == value for name, value in desired.items())
+        logging.info(f"Board initialization {'succeeded' if self.is_sync else 'failed'}.")
+
+        await self.change_board_output_mode(self.output_mode)
+
+    def change_length_units(self, value: str):
+        """Value must be one of [mm, cm]"""
+        self.length_units = value
+        logging.info(f"Length Units Change to {value}")
+
+    def change_stylus(self, value: str):
+        self.stylus = value
+        self.stylus_offset = self.devices_specifications.stylus_offset[self.stylus]
+        logging.info(f'Stylus set to {self.stylus}. Stylus offset {self.stylus_offset}')
+
+    def cycle_stylus(self):
+        self.change_stylus(next(self.stylus_cyclical_list))
+
+    async def change_board_output_mode(self, value: str):
+        """Value must be one of [length, bottom, top]
+        """
+        self.output_mode = value
+        for coroutine in set_output_mode_settings(self):
+            await coroutine
+        logging.info(f'Board entry: {self.output_mode}.')
+
+    async def set_mode_key_backlight_pattern(self, value: bool):
+        """Only works for XT models.
+        """
+        for coroutine in set_mode_key_backlight_pattern(self, value):
+            await coroutine
+
+    async def c_ping(self):
+        return await self.send_command(*protocol.ping())
+
+    async def c_get_board_stats(self):
+        return await self.send_command(*protocol.get_board_stats())
+
+    async def c_get_battery_level(self):
+        return await self.send_command(*protocol.get_battery_level())
+
+    async def c_get_battery_time_to_empty(self):
+        """Micro Only"""
+        return await self.send_command(*protocol.get_battery_time_to_empty())
+
+    async def c_get_temperature_humidity(self):
+        return await self.send_command(*protocol.get_temperature_humidity())
+
+    async def c_board_initialization(self):
+        replies = await self.send_command(*protocol.board_initialization())
+        await self.close()
+        self.internal_board_state = InternalBoardState()  # The board settings are reset.
+        return replies
+
+    async def c_set_interface(self, value: int):
+        """
+        Notes
+        -----
+          Only the DCS5Linkstream Interface is now supported.
+        """
+        return await self.send_command(*protocol.set_interface(value))
+
+    async def c_flash_fuel_gauge(self):
+        """For the Micro the fuel gauge is the led rings."""
+        return await self.send_command(*protocol.flash_fuel_gauge())
+
+    async def c_set_fuel_gauge(self, value: int, color: list = None):
+        """For the Micro the fuel gauge is the led rings.
+        Parameters
+        ----------
+        value :
+            Int (byte) encoding the pattern e.g. int('00110000',2)
+        color : for micro only.
+            (r, g, b, w) Int representing hex value color value.
+        """
+        if self.devices_specifications.control_box.model == 'xt':
+            color = None
+        return await self.send_command(*protocol.set_fuel_gauge(value, color))
+
+    async def c_set_fuel_gauge_temporary(self, delay: int, value: int, color: list = None):
+        """For the Micro the fuel gauge is the led rings.
+
+        Parameters
+        ----------
+        delay :
+           Duration of the led pattern in second. (0-255)
+        value :
+            Int (byte) encoding the pattern e.g. int('00110000',2)
+        color : for micro only.
+            (r, g, b, w) Int representing hex value color value.
+        """
+        if self.devices_specifications.control_box.model == 'xt':
+            color = None
+        return await self.send_command(*protocol.set_fuel_gauge_temporary(delay, value, color))
+
+    async def c_set_output_mode_fuel_gauge(self, output_mode: str):
+        """Show `output_mode` on the fuel gauge (XT) or on the led rings (Micro)."""
+        return await self.send_command(
+            *protocol.set_output_mode_fuel_gauge(self.devices_specifications.control_box.model, output_mode)
+        )
+
+    async def c_set_backlighting_level(self, level: int, persistent=True):
+        if level is None:
+            level = self.control_box_parameters.max_backlighting_level
+        if not 0 <= level <= self.control_box_parameters.max_backlighting_level:
+            raise ValueError(f"Backlighting level range: (0, {self.control_box_parameters.max_backlighting_level})")
+        if persistent is True:
+            self.persistent_backlight_level = level
+        return await self.send_command(*protocol.set_backlighting_level(level))
+
+    async def c_set_key_backlighting_level(self, level: int, key: int):
+        if level is None:
+            level = self.control_box_parameters.max_backlighting_level
+        if not 0 <= level <= self.control_box_parameters.max_backlighting_level:
+            raise ValueError(f"Backlighting level range: (0, {self.control_box_parameters.max_backlighting_level})")
+        return await self.send_command(*protocol.set_key_backlighting_level(level, key))
+
+    async def c_set_stylus_detection_message(self, value: bool):
+        """
+        When disabled (false): %t0 %t1 are not sent
+        """
+        return await self.send_command(*protocol.set_stylus_detection_message(value))
+
+    async def c_set_stylus_settling_delay(self, value: int = 1):
+        if not self.control_box_parameters.min_settling_delay <= value <= self.control_box_parameters.max_settling_delay:
+            raise ValueError(
+                f"Settling delay value range: ({self.control_box_parameters.min_settling_delay}, {self.control_box_parameters.max_settling_delay})")
+        return await self.send_command(*protocol.set_stylus_settling_delay(value))
+
+    async def c_set_stylus_max_deviation(self, value: int):
+        if not self.control_box_parameters.min_max_deviation <= value <= self.control_box_parameters.max_max_deviation:
+            raise ValueError(
+                f"Max deviation value range: ({self.control_box_parameters.min_max_deviation}, {self.control_box_parameters.max_max_deviation})")
+        return await self.send_command(*protocol.set_stylus_max_deviation(value))
+
+    async def c_set_stylus_number_of_reading(self, value: int = 5):
+        return await self.send_command(*protocol.set_stylus_number_of_reading(value))
+
+    async def c_restore_cal_data(self):
+        return await self.send_command(*protocol.restore_cal_data())
+
+    async def c_clear_cal_data(self):
+        replies = await self.send_command(*protocol.clear_cal_data())
+        self.internal_board_state.calibrated = False
+        return replies
+
+    async def c_check_calibration_state(self):
+        return await self.send_command(*protocol.check_calibration_state())
+
+    async def c_set_calibration_points_mm(self, pt: int, pos: int):
+        return await self.send_command(*protocol.set_calibration_points_mm(pt, pos))
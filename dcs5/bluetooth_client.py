@@ -1,57 +1,123 @@
 import logging
-import platform
 import socket
 import threading
 import time
-
-MONITORING_DELAY = 2  # WINDOWS ONLY
-BOARD_MSG_ENCODING = 'UTF-8'
-BUFFER_SIZE = 1024
-
-
-class BluetoothClient:
+from json.decoder import JSONDecodeError
+from typing import *
+
+from dcs5 import PORT_CACHE_FILE
+from dcs5.transports import Transport
+from dcs5.utils import json2dict, dict2json
+
+
+def load_cached_port(mac_address: str) -> Optional[int]:
+    """Return the last port that worked for `mac_address`, if any."""
+    try:
+        return json2dict(PORT_CACHE_FILE)[mac_address]['port']
+    except (OSError, JSONDecodeError, KeyError, TypeError):
+        return None
+
+
+def cache_port(mac_address: str, port: int):
+    try:
+        cache = json2dict(PORT_CACHE_FILE)
+    except (OSError, JSONDecodeError):
+        cache = {}
+    cache[mac_address] = {
+        'port': port,
+        'last_connected': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
+    }
+    try:
+        dict2json(PORT_CACHE_FILE, cache)
+    except OSError:
+        logging.error(f'Could not write the port cache file: {PORT_CACHE_FILE}')
+
+
+def _abort_probe(sock: socket.socket):
+    """Interrupt a connect blocked in another thread and close the socket.
+
+    `close` alone neither wakes the blocked thread nor stops the connection attempt, `shutdown` does.
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Not connected yet.
+    sock.close()
+
+
+class BluetoothClient(Transport):
     """RFCOMM ports goes from 1 to 30."""
     min_port = 1
     max_port = 30
     reconnection_delay = 5
+    cached_port_timeout = 2  # seconds. A stale cached port must not use the connection deadline.
 
     def __init__(self):
+        super().__init__()
         self.mac_address: str = None
-        self.port: int = None
-        self.socket: socket.socket = None
-        self.default_timeout = 0.1
-        self._is_connected = False
-        self.error_msg = ""
-        self.errors = {
-            0: 'Socket timeout',
-            1: 'No available ports',
-            2: 'Device not found',
-            3: 'Bluetooth turned off',
-            4: 'Connection broken',
-            5: 'Device Unavailable',
-            6: 'Client closed',
-            99: 'Unknown Error',
-        }
-
-        self._socket_spam_thread: threading.Thread = None
-
-    @property
-    def socket_timeout(self):
-        return self.socket.gettimeout()
-
-    @property
-    def is_connected(self):
-        return self._is_connected
-
-    def set_timeout(self, value: int):
-        self.socket.settimeout(value)
-
-    def connect(self, mac_address: str = None, timeout: int = None):
-        self.mac_address = mac_address
+
+    def connect(self, mac_address: str = None, timeout: int = None, concurrent: bool = False):
+        """
+        Parameters
+        ----------
+        mac_address :
+            Board mac address.
+        timeout :
+            Connection deadline in seconds, shared by the cached port attempt and the ports probing.
+        concurrent :
+            If True, all the ports are probed at the same time and the first one to connect is kept.
+        """
+        self.mac_address = self.address = mac_address
         timeout = timeout or self.default_timeout
         logging.info(f'Attempting to connect to board. Timeout: {timeout} seconds')
 
+        deadline = time.monotonic() + timeout
+        if not self._connect_cached_port(min(timeout, self.cached_port_timeout)):
+            if (remaining := deadline - time.monotonic()) <= 0:
+                logging.error('Connection deadline reached.')
+                self.error_msg = self.errors[0]
+            elif concurrent is True:
+                self._connect_concurrent(remaining)
+            else:
+                self._connect_sequential(deadline)
+
+        if self._is_connected:
+            logging.info(f'Connected to port {self.port}')
+            cache_port(self.mac_address, self.port)
+            logging.info(f'Socket name: {self.socket.getsockname()}')
+            self._on_connect()
+
+    def _connect_cached_port(self, timeout: float) -> bool:
+        """Try the last port that worked for this mac address. Returns True if connected."""
+        if (port := load_cached_port(self.mac_address)) is None:
+            return False
+
+        logging.info(f'Trying cached port: {port}')
+        _socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        _socket.settimeout(timeout)
+        try:
+            _socket.connect((self.mac_address, port))
+        except PermissionError:
+            logging.info('Client.connect: PermissionError')
+        except OSError as err:
+            self._process_os_error_code(err)
+        else:
+            self.socket = _socket
+            self.port = port
+            self._is_connected = True
+            return True
+
+        _socket.close()
+        logging.info(f'Cached port {port} failed. Scanning all ports.')
+        return False
+
+    def _connect_sequential(self, deadline: float):
+        """Probe the ports one after the other until `deadline` (time.monotonic)."""
         for port in range(self.min_port, self.max_port + 1):  # check for all available ports
+            if (timeout := deadline - time.monotonic()) <= 0:
+                logging.error('Connection deadline reached.')
+                self.error_msg = self.errors[0]
+                break
             self.socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
             self.socket.settimeout(timeout)
             try:
@@ -59,11 +125,6 @@ class BluetoothClient:
                 self.socket.connect((self.mac_address, port))
                 self.port = port
                 self._is_connected = True
-                logging.info(f'Connected to port {self.port}')
-                logging.info(f'Socket name: {self.socket.getsockname()}')
-
-                if platform.system() == 'Windows':
-                    self.start_connection_spam_thread()
                 break
 
             except PermissionError:
@@ -80,118 +141,74 @@ class BluetoothClient:
                     self.error_msg = self.errors[err_code]
                     break
 
-        self.socket.settimeout(self.default_timeout)
+        if self.socket is not None:
+            self.socket.settimeout(self.default_timeout)
 
-    def send(self, command: str):
-        try:
-            self.socket.sendall(command.encode(BOARD_MSG_ENCODING))
-        except OSError as err:
-            logging.info(f'OSError on sendall')
-            self.error_msg = self.errors[self._process_os_error_code(err)]
-            self.close()
+    def _connect_concurrent(self, timeout: float):
+        """Probe every port in its own thread. The first socket to connect is kept and the other are closed.
 
-    def receive(self):
-        try:
-            return self.socket.recv(BUFFER_SIZE).decode(BOARD_MSG_ENCODING)
-        except OSError as err:
-            if err_code := self._process_os_error_code(err) != 0:
-                self.error_msg = self.errors[err_code]
-                self.close()
-            return ""
-
-    def clear(self):
-        while self.receive() != "":
-            continue
-
-    def close(self):
-        self.socket.close()
-        self._is_connected = False
-
-    def start_connection_spam_thread(self):
-        self._socket_spam_thread = threading.Thread(target=self._spam_socket, name='spam', daemon=True)
-        self._socket_spam_thread.start()
-
-    def _spam_socket(self):
-        """This is to raise a connection OSError if the connection is lost."""
-        while self._is_connected:
-            self.send(" ")  # A Space is not a recognized command. Thus nothing is return.
-            time.sleep(MONITORING_DELAY)
-
-    def _process_os_error_code(self, err) -> int:
+        `timeout` is the deadline for the whole probing.
         """
-        Parameters
-        ----------
-        err : OS error code.
-
-        Returns
-        -------
-        0: Socket timeout
-        1: Port Unavailable
-        2: Device not Found
-        3: Bluetooth turned off
-        4: Connection broken
-        5: Device Unavailable
-        6: Client closed.
-        99: Unknown Error
-
-        """
-        match err.errno:
-            case None:
-                return 0
-            case 9:
-                logging.error(f'Bad file descriptor. (err{err.errno})')
-                return 6
-            case 16:
-                logging.error(f'Port unavailable. (err{err.errno})')
-                return 1
-            case 22:
-                logging.error(f'Port does not exist. (err{err.errno})')
-                return 1
-            case 77:
-                logging.error(f'Bad file descriptor. (err{err.errno})')
-                return 6
-            case 111:
-                logging.error(f'Device unavailable. (err{err.errno})')
-                return 5
-            case 112:
-                logging.error(f'Device not found. (err{err.errno})')
-                return 2
-            case 104:
-                logging.error(f'Connection broken. (err{err.errno})')
-                return 4
-            case 110:
-                logging.error(f'Connection broken. (err{err.errno})')
-                return 4
-            case 112:
-                logging.error(f'Device not found. (err{err.errno})')
-                return 2
-            case 113:
-                logging.error(f'Bluetooth turned off. (err{err.errno})')
-                return 3
-            case 10022:
-                logging.error(f'Bluetooth turned off. (err{err.errno})')
-                return 3
-            case 10038:
-                logging.error(f'Bad file descriptor. (err{err.errno})')
-                return 6
-            case 10048:
-                logging.error(f'Device unavailable. (Maybe) (err{err.errno})')
-                return 5
-            case 10049:
-                logging.error(f'Port does not exist. (err{err.errno})')
-                return 1
-            case 10050:
-                logging.error(f'Bluetooth turned off. (err{err.errno})')
-                return 3
-            case 10053:
-                logging.error(f'Connection broken. (err{err.errno})')
-                return 4
-            case 10060:
-                logging.error(f'Device not found. (err{err.errno})')
-                return 2
-            case 10064:
-                logging.error(f'Port {self.port} unavailable. (err{err.errno})')
-                return 1
-            case _:
-                logging.error(f'OSError (new): {err.errno}')
-                return 99
+        ports = list(range(self.min_port, self.max_port + 1))
+        deadline = time.monotonic() + timeout
+        lock = threading.Lock()
+        done = threading.Event()
+        sockets: Dict[int, socket.socket] = {}
+        err_codes: Dict[int, int] = {}
+        winner: List[int] = []
+
+        def probe(port: int):
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+            sock.settimeout(max(deadline - time.monotonic(), 0.01))
+            with lock:
+                if done.is_set():
+                    sock.close()
+                    return
+                sockets[port] = sock
+            try:
+                sock.connect((self.mac_address, port))
+            except PermissionError:
+                logging.info(f'Client.connect: PermissionError (port {port})')
+                err_code = None
+            except OSError as err:
+                err_code = self._process_os_error_code(err)
+            else:
+                with lock:
+                    if not done.is_set():
+                        winner.append(port)
+                        done.set()
+                        return
+                sock.close()  # Another port won the race.
+                return
+
+            with lock:
+                err_codes[port] = err_code
+                if len(err_codes) == len(ports):
+                    done.set()
+
+        logging.info(f'Probing ports {ports[0]} to {ports[-1]} concurrently.')
+        for port in ports:
+            threading.Thread(target=probe, args=(port,), name=f'probe {port}', daemon=True).start()
+
+        done.wait(timeout)
+
+        with lock:
+            done.set()  # Cancel the remaining probes.
+            for port, sock in sockets.items():
+                if port not in winner:
+                    _abort_probe(sock)
+
+        if winner:
+            self.port = winner[0]
+            self.socket = sockets[self.port]
+            self._is_connected = True
+        elif any(code not in (None, 1) for code in err_codes.values()):
+            self.error_msg = self.errors[next(code for code in err_codes.values() if code not in (None, 1))]
+        elif None in err_codes.values():
+            self.error_msg = 'Permission error'
+        elif len(err_codes) == len(ports):
+            logging.error('No available ports were found.')
+            self.error_msg = self.errors[1]
+        else:
+            logging.error('Connection deadline reached.')
+            self.error_msg = self.errors[0]
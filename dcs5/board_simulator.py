@@ -0,0 +1,326 @@
+"""
+This module contains a simulator of the DCS5 XT and Micro boards (firmware 2.0).
+
+The simulator answers the commands sent by the Dcs5Controller and generates length measurements,
+swipes and control box key events. It can be served over a socketpair, a pseudo-terminal or a local tcp port:
+
+    simulator = Dcs5BoardSimulator(model='xt', event_rate=2, event_jitter=0.1)
+    client_socket = simulator.serve_socketpair()
+
+or from the command line:
+
+    python -m dcs5.board_simulator --model micro --tcp 9000 --rate 2
+
+References
+----------
+    https://bigfinllc.com/wp-content/uploads/Big-Fin-Scientific-Fish-Board-Integration-Guide-V2_0.pdf
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+from typing import *
+
+BOARD_MSG_ENCODING = 'UTF-8'
+COMMAND_DELIMITER = b"#"
+BUFFER_SIZE = 1024
+
+CALIBRATION_DELAY = 1  # seconds before a calibration point is confirmed.
+
+XT_KEYS = [f"{i:02d}" for i in range(1, 33)]
+MICRO_KEYS = [str(i) for i in range(1, 4)]
+
+
+class _FdConnection:
+    """Socket like wrapper around a file descriptor (pty)."""
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def recv(self, size: int) -> bytes:
+        try:
+            return os.read(self.fd, size)
+        except OSError:  # EIO when the other end of the pty is closed.
+            return b""
+
+    def sendall(self, data: bytes):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Dcs5BoardSimulator:
+    def __init__(
+            self,
+            model: str = 'xt',
+            firmware: str = '0200',
+            event_rate: float = 0,
+            event_jitter: float = 0,
+            length_range: Tuple[int, int] = (0, 600),
+            swipe_probability: float = 0.1,
+            key_probability: float = 0.2,
+            seed: int = None
+    ):
+        """
+        Parameters
+        ----------
+        model :
+            `xt` or `micro`.
+        firmware :
+            Firmware version returned in the board stats.
+        event_rate :
+            Number of unsolicited events (measurement, swipe, key) per second. 0 to disable.
+        event_jitter :
+            Random variation (+/- seconds) added to the delay between events.
+        length_range :
+            Range (mm) of the generated length measurements.
+        swipe_probability :
+            Probability that an event is a swipe (followed by its length measurement).
+        key_probability :
+            Probability that an event is a control box key.
+        seed :
+            Seed of the events random generator.
+        """
+        if model not in ['xt', 'micro']:
+            raise ValueError("model must be one of ['xt', 'micro']")
+        self.model = model
+        self.firmware = firmware
+        self.event_rate = event_rate
+        self.event_jitter = event_jitter
+        self.length_range = length_range
+        self.swipe_probability = swipe_probability
+        self.key_probability = key_probability
+        self.random = random.Random(seed)
+
+        self.interface = 0
+        self.stylus_status_msg = 0
+        self.settling_delay = 1
+        self.max_deviation = 6
+        self.number_of_reading = 5
+        self.backlighting_level = 0
+        self.calibrated = True
+        self.cal_pts = {1: 100, 2: 600}
+        self.battery_level = 100
+        self.is_charging = False
+        self.temperature = 20
+        self.humidity = 50
+
+        self.commands_received: List[str] = []
+
+        self.is_running = False
+        self._connection = None
+        self._send_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._server_socket: socket.socket = None
+
+    def serve_socketpair(self) -> socket.socket:
+        """Serve the simulator on one end of a socketpair and return the other end."""
+        client_socket, board_socket = socket.socketpair()
+        self.start(board_socket)
+        return client_socket
+
+    def serve_pty(self) -> str:
+        """Serve the simulator on a pseudo-terminal and return the name of the device to open."""
+        import tty  # Unix only.
+        main_fd, secondary_fd = os.openpty()
+        tty.setraw(secondary_fd)
+        self.start(_FdConnection(main_fd))
+        return os.ttyname(secondary_fd)
+
+    def serve_tcp(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """Accept a single tcp connection at a time on host:port. Returns the bound port."""
+        self._server_socket = socket.create_server((host, port))
+        self.is_running = True
+        thread = threading.Thread(target=self._accept_loop, name='simulator server', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self._server_socket.getsockname()[1]
+
+    def _accept_loop(self):
+        while self.is_running:
+            try:
+                connection, address = self._server_socket.accept()
+            except OSError:
+                break
+            logging.info(f'Simulator: connection from {address}')
+            self.serve(connection)
+
+    def start(self, connection):
+        """Serve `connection` in a thread."""
+        self.is_running = True
+        thread = threading.Thread(target=self.serve, args=(connection,), name='simulator', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        self.is_running = False
+        if self._server_socket is not None:
+            self._server_socket.close()
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except OSError:
+                pass
+
+    def serve(self, connection):
+        """Answer the commands received on `connection` until it is closed. Blocking."""
+        self._connection = connection
+        self.is_running = True
+        if self.event_rate > 0:
+            thread = threading.Thread(target=self._generate_events, args=(connection,), name='simulator events',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        buffer = b""
+        while self.is_running:
+            try:
+                data = connection.recv(BUFFER_SIZE)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            *commands, buffer = buffer.split(COMMAND_DELIMITER)
+            for command in commands:
+                command = command.decode(BOARD_MSG_ENCODING).strip() + "#"
+                if command == "#":  # Spaces sent to monitor the connection.
+                    continue
+                self.commands_received.append(command)
+                self._reply(connection, command)
+
+        if self._connection is connection:
+            self._connection = None
+        logging.info('Simulator: connection closed.')
+
+    def _send(self, connection, *messages: str):
+        with self._send_lock:
+            try:
+                connection.sendall("".join(messages).encode(BOARD_MSG_ENCODING))
+            except OSError:
+                pass
+
+    def _reply(self, connection, command: str):
+        if (replies := self.process_command(command)) is not None:
+            self._send(connection, *replies)
+
+        if (match := re.fullmatch(r"&(\d)r#", command)) is not None:
+            threading.Timer(CALIBRATION_DELAY, self._send, args=(connection, f"&{match[1]}c#\r")).start()
+
+    def process_command(self, command: str) -> Optional[List[str]]:
+        """Update the simulated board and return the board replies to `command`."""
+        if command == "&a#":
+            return ["%a#\r"]
+        if command == "b#":
+            return [f"%b:{self.model.upper()},{self.firmware},{self.number_of_reading},{self.interface}#\r"]
+        if command == "&q#":
+            return [f"%q:{self.battery_level},{int(self.is_charging)}#\r"]
+        if command == "&qe#":
+            return [f"%qe:{65535 if self.is_charging else 600}#\r"]
+        if command == "&t#":
+            return [f"%t,{self.temperature},{self.humidity}#\r"]
+        if command == "&u#":
+            return [f"%u:{int(self.calibrated)}#\r"]
+        if command == "&ra#":
+            return ["%ra#\r"]
+        if command == "&init#":
+            return ["Setting EEPROM init flag.\r", "Rebooting in 2 seconds.\r"]
+        if command == "&ca#":
+            self.calibrated = False
+            return None
+        if command.startswith("&cr,"):
+            self.calibrated = True
+            return None
+
+        if (match := re.fullmatch(r"&(\d)r#", command)) is not None:
+            return [f"&{match[1]}r#\r"]
+        if (match := re.fullmatch(r"&(\d)mm,(\d+)#", command)) is not None:
+            self.cal_pts[int(match[1])] = int(match[2])
+            return [f"%{match[1]}mm,{match[2]}#\r"]
+
+        if (match := re.fullmatch(r"&(\w+),(.*)#", command)) is None:
+            logging.warning(f'Simulator: unknown command {[command]}')
+            return None
+
+        name, args = match[1], match[2]
+        if name == "pl":
+            self.interface = int(args)
+            host_app = {0: 'DCSLinkstream', 1: "FEED"}[self.interface]
+            return [f"HostApp={host_app}\r", f"%pl,{args}#\r"]
+        if name == "sn":
+            self.stylus_status_msg = int(args)
+            return [f"%sn:{args}#\r"]
+        if name == "di":
+            self.settling_delay = int(args)
+            return [f"%di:{args}#\r"]
+        if name == "dm":
+            self.max_deviation = int(args)
+            return [f"%dm:{args}#\r"]
+        if name == "dn":
+            self.number_of_reading = int(args)
+            return [f"%dn:{args}#\r"]
+        if name == "la":
+            self.backlighting_level = int(args)
+            return [f"%la,{args}#\r"]
+        if name in ["lk", "lf", "lt"]:
+            return [f"%{name},{args}#\r"]
+
+        logging.warning(f'Simulator: unknown command {[command]}')
+        return None
+
+    def _generate_events(self, connection):
+        while self.is_running and self._connection is connection:
+            delay = 1 / self.event_rate + self.random.uniform(-self.event_jitter, self.event_jitter)
+            time.sleep(max(delay, 0))
+            if self.is_running and self._connection is connection:
+                self._send(connection, *self.next_event())
+
+    def next_event(self) -> List[str]:
+        """Return the messages of a random unsolicited event."""
+        draw = self.random.random()
+        if draw < self.key_probability:
+            if self.model == 'xt':
+                return [f"%k,{self.random.choice(XT_KEYS)}#\r"]
+            return [f"%hs,{self.random.choice(MICRO_KEYS)}#\r"]
+
+        length = self.random.randint(*self.length_range)
+        messages = [f"%l,{length}#\r"]
+        if draw < self.key_probability + self.swipe_probability:
+            messages.insert(0, f"%s,{self.random.randint(6, 50)}#\r")
+        if self.stylus_status_msg:
+            messages = ["%t,1#\r"] + messages + ["%t,0#\r"]
+        return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DCS5 board simulator.')
+    parser.add_argument('--model', choices=['xt', 'micro'], default='xt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--tcp', type=int, default=None, help='Serve on this tcp port.')
+    parser.add_argument('--pty', action='store_true', help='Serve on a pseudo-terminal.')
+    parser.add_argument('--rate', type=float, default=0, help='Unsolicited events per second.')
+    parser.add_argument('--jitter', type=float, default=0, help='Events delay jitter in seconds.')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+    simulator = Dcs5BoardSimulator(model=args.model, event_rate=args.rate, event_jitter=args.jitter, seed=args.seed)
+    if args.pty:
+        print(f'Simulator serving on {simulator.serve_pty()}')
+    else:
+        print(f'Simulator serving on {args.host}:{simulator.serve_tcp(args.host, args.tcp or 0)}')
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
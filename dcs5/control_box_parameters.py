@@ -10,6 +10,9 @@ class BaseControlBoxParameters:
     max_settling_delay = 20
     min_max_deviation = 1
     max_max_deviation = 100
+    min_command_interval = 0.01  # seconds between two writes. Lower value might send message too quickly.
+    max_commands_per_write = 1  # commands sent with a single write. Not validated above 1 on the firmwares.
+    max_commands_in_flight = 4  # commands sent and awaiting a reply. More might overrun the board input buffer.
 
 @dataclass
 class XtControlBoxParameters(BaseControlBoxParameters):
@@ -12,38 +12,312 @@ References
 """
 
 import logging
+import random
 import re
 import threading
 import time
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
 from itertools import cycle
 from queue import Queue
 from typing import *
 
 import pyautogui as pag
 
-from dcs5 import PRINT_COMMAND
 from dcs5.bluetooth_client import BluetoothClient
+from dcs5.transports import Transport, TcpClient, SerialClient, InProcessClient
+from dcs5 import protocol
+from dcs5.protocol import (
+    decode_board_message, LengthMeasurement, Swipe, ControlBoxKey, StylusStatus, UsbPlugged, Reply
+)
 from dcs5.keyboard_emulator import KeyboardEmulator
+from dcs5.logger import wire_logger, WIRE_LOGGING_LEVEL, RateLimitedLogger
 
-from dcs5.controller_configurations import load_config, ControllerConfiguration, ConfigError
+from dcs5.controller_configurations import (
+    load_config, ControllerConfiguration, ConfigError, Client, ReadingProfile, KeyTables, KeyEntry, KeyAction
+)
 from dcs5.devices_specifications import load_devices_specification, DevicesSpecifications
 from dcs5.control_box_parameters import XtControlBoxParameters, MicroControlBoxParameters
 from marel_marine_scale_controller.marel_controller import MarelController
 
-BOARD_MESSAGE_DELIMITER = "\r"
-
 pag.FAILSAFE = False
 
-BOARD_STATE_MONITORING_SLEEP = 5
+TELEMETRY_HISTORY_SIZE = 1000  # samples kept per metric.
+TELEMETRY_IDLE_PERIOD = 300  # seconds without measurement, swipe or key before the telemetry polling stops.
+TELEMETRY_PAUSE_CHECK = 1  # seconds between checks while the telemetry is paused.
+TELEMETRY_MEASURING_SLOWDOWN = 3  # polling intervals factor while the stylus is active.
+LOW_BATTERY_LEVEL = 20  # %. The battery is polled at its minimum interval at or below this level.
+
+LIVENESS_IDLE_PERIOD = 2  # seconds without inbound traffic before the board is pinged.
+
+LIVENESS_MAX_MISSED_PINGS = 2
+COMMAND_TIMEOUT = 1  # seconds to wait for the replies to a command.
+COMMAND_RETRIES = 2  # resends of the idempotent commands (settings and queries) on timeout.
+BOARD_SYNC_TIMEOUT = 15  # seconds to wait for the board to acknowledge the settings sent by a sync or an initialization.
+
+PRIORITY_INTERACTIVE = 0  # Feedback to the operator: fuel gauge, backlight and ping.
+PRIORITY_CONFIGURATION = 1  # Board settings: interface, reading profile, calibration.
+PRIORITY_BACKGROUND = 2  # Telemetry: battery and temperature. Deferred while the stylus is active.
+COMMAND_PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_CONFIGURATION, PRIORITY_BACKGROUND)
+
+STYLUS_ACTIVE_PERIOD = 2  # seconds after a measurement or swipe during which the stylus is considered active.
+BACKGROUND_MAX_DEFERRAL = 30  # seconds a background command can be deferred while the stylus is active.
+
+
+@dataclass
+class ReconnectPolicy:
+    """Exponential backoff between reconnection attempts.
+
+    initial_delay :
+        Delay (seconds) after the first failed attempt.
+    max_delay :
+        Maximum delay between attempts.
+    multiplier :
+        Factor applied to the delay after each failed attempt.
+    jitter :
+        Random fraction (+/-) of the delay added to it.
+    budget :
+        Total time (seconds) allowed to reconnect. None to retry forever.
+    connect_timeout :
+        Timeout of a connection attempt.
+    """
+    initial_delay: float = 0.25
+    max_delay: float = 10
+    multiplier: float = 2
+    jitter: float = 0.1
+    budget: float = None
+    connect_timeout: float = 30
+
+    def delays(self) -> Iterator[float]:
+        delay = self.initial_delay
+        while True:
+            yield delay * (1 + random.uniform(-self.jitter, self.jitter))
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
+class LinkLivenessMonitor:
+    """Check that the link with the board is alive.
+
+    Any inbound frame is a proof of life. A ping is sent only after `idle_period` seconds without
+    inbound traffic and the link is declared dead (client closed) after `max_missed_pings` pings
+    are left unanswered.
+    """
+    def __init__(self, controller: "Dcs5Controller", idle_period: float = LIVENESS_IDLE_PERIOD,
+                 max_missed_pings: int = LIVENESS_MAX_MISSED_PINGS):
+        self.controller = controller
+        self.idle_period = idle_period
+        self.max_missed_pings = max_missed_pings
+        self.last_activity: float = None
+        self.ping_sent_time: float = None
+        self.missed_pings = 0
+        self.round_trip_time: float = None
+
+    def reset(self):
+        self.last_activity = time.monotonic()
+        self.ping_sent_time = None
+        self.missed_pings = 0
+
+    def time_until_check(self) -> float:
+        """Seconds until the link needs to be checked."""
+        since = self.ping_sent_time if self.ping_sent_time is not None else self.last_activity
+        return max(since + self.idle_period - time.monotonic(), 0)
+
+    def on_frames(self, frames: List[str]):
+        self.last_activity = time.monotonic()
+        if self.ping_sent_time is not None and "%a#\r" in frames:
+            self.round_trip_time = self.last_activity - self.ping_sent_time
+            logging.debug(f'Ping round trip time: {self.round_trip_time * 1000:.1f} ms')
+        self.ping_sent_time = None
+        self.missed_pings = 0
+
+    def check(self):
+        """Ping the board if it has been idle, declare the link dead after too many missed pings."""
+        if self.time_until_check() > 0:
+            return
+        if self.ping_sent_time is not None:
+            self.missed_pings += 1
+            logging.warning(f'Ping not answered ({self.missed_pings}/{self.max_missed_pings}).')
+            if self.missed_pings >= self.max_missed_pings:
+                logging.error('Link with the board is dead.')
+                self.controller.client.error_msg = self.controller.client.errors[4]
+                self.controller.client.close()
+                return
+        self.ping_sent_time = time.monotonic()
+        self.controller.c_ping()
+
+
+class TelemetrySample(NamedTuple):
+    time: float  # time.time() of the reply.
+    value: tuple  # Values of the metric `fields`.
+
+
+@dataclass
+class TelemetryMetric:
+    """Board value polled by the BoardTelemetryScheduler.
+
+    name :
+        Name of the metric.
+    command :
+        Name of the Dcs5Controller method polling the board.
+    fields :
+        InternalBoardState fields updated by the reply.
+    min_interval :
+        Polling interval (seconds) after a change.
+    max_interval :
+        Polling interval once the values are stable. The interval doubles after every unchanged value.
+    """
+    name: str
+    command: str
+    fields: Tuple[str, ...]
+    min_interval: float
+    max_interval: float
+    interval: float = None
+    next_poll: float = 0
+    history: Deque[TelemetrySample] = field(default_factory=lambda: deque(maxlen=TELEMETRY_HISTORY_SIZE))
+
+    @property
+    def last_value(self) -> Optional[tuple]:
+        return self.history[-1].value if self.history else None
+
+
+class BoardTelemetryScheduler:
+    """Poll the board battery and temperature, each metric at its own adaptive interval.
+
+    A metric is polled every `min_interval` seconds after a change and the interval doubles with every
+    unchanged value up to `max_interval`. The battery is polled every `min_interval` when its level is
+    at or below `LOW_BATTERY_LEVEL`. Intervals are `TELEMETRY_MEASURING_SLOWDOWN` times longer while the
+    stylus is active. Polling stops while the board is muted or idle (no measurement, swipe or key for
+    `TELEMETRY_IDLE_PERIOD` seconds).
+
+    The values polled are kept in the metric `history` with the time of the reply.
+    """
+    def __init__(self, controller: "Dcs5Controller"):
+        self.controller = controller
+        self.metrics: Dict[str, TelemetryMetric] = {}
+        self._wakeup = threading.Event()
+
+    def reset(self):
+        """Build the metrics of the board model. Histories are kept across resets."""
+        metrics = [
+            TelemetryMetric('battery', 'c_get_battery_level', ('battery_level', 'is_charging'), 5, 300),
+            TelemetryMetric('temperature_humidity', 'c_get_temperature_humidity', ('temperature', 'humidity'), 10, 600),
+        ]
+        if self.controller.devices_specifications.control_box.model == "micro":
+            metrics.append(TelemetryMetric(
+                'battery_time_to_empty', 'c_get_battery_time_to_empty', ('battery_time_to_empty',), 10, 300
+            ))
+        for metric in metrics:
+            if metric.name in self.metrics:
+                metric.history = self.metrics[metric.name].history
+            metric.interval = metric.min_interval
+        self.metrics = {metric.name: metric for metric in metrics}
+
+    def wakeup(self):
+        """Interrupt the wait between polls, e.g. when listening stops or the board is unmuted."""
+        self._wakeup.set()
+
+    def is_paused(self) -> bool:
+        last_activity = self.controller.socket_listener.last_user_activity
+        return self.controller.is_muted or (
+                last_activity is not None and time.monotonic() - last_activity > TELEMETRY_IDLE_PERIOD
+        )
+
+    def run(self):
+        """Poll the metrics until listening stops. Blocking."""
+        self.reset()
+        while self.controller.is_listening:
+            if self.is_paused():
+                timeout = TELEMETRY_PAUSE_CHECK
+            else:
+                now = time.monotonic()
+                for metric in self.metrics.values():
+                    if metric.next_poll <= now and self.controller.is_listening:
+                        self.poll(metric)
+                timeout = max(min(metric.next_poll for metric in self.metrics.values()) - time.monotonic(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def poll(self, metric: TelemetryMetric):
+        """Poll `metric`, wait for the reply and schedule the next poll."""
+        request = getattr(self.controller, metric.command)()
+        if request.wait():
+            value = tuple(getattr(self.controller.internal_board_state, name) for name in metric.fields)
+            if value != metric.last_value:
+                metric.interval = metric.min_interval
+            else:
+                metric.interval = min(metric.interval * 2, metric.max_interval)
+            metric.history.append(TelemetrySample(time.time(), value))
+
+        interval = metric.interval
+        battery_level = self.controller.internal_board_state.battery_level
+        if metric.name == 'battery' and battery_level is not None and battery_level <= LOW_BATTERY_LEVEL:
+            interval = metric.min_interval
+        elif self.controller.socket_listener.time_until_stylus_idle() > 0:
+            interval *= TELEMETRY_MEASURING_SLOWDOWN
+        metric.next_poll = time.monotonic() + interval
+
+
+rate_limited_log = RateLimitedLogger()  # For the messages that can be repeated for every frame.
 
-AFTER_SENT_SLEEP = 0.01  # lower value might send message too quickly.
 
-HANDLER_SLEEP = 0.01
+def load_controller_configs(config_path: str, devices_specifications_path: str) -> Tuple[
+        ControllerConfiguration, DevicesSpecifications, Union[XtControlBoxParameters, MicroControlBoxParameters]]:
+    """Load and validate the controller configuration against the devices specifications."""
+    if (devices_specifications := load_devices_specification(devices_specifications_path)) is None:
+        raise ConfigError(f'Error in {devices_specifications_path}. File could not be loaded.')
 
-LISTENER_SLEEP = 0.005
+    if (config := load_config(config_path)) is None:
+        raise ConfigError(f'Error in {config_path}. File could not be loaded.')
 
-CONNECTION_MONITOR_SLEEP = 1
+    match devices_specifications.control_box.model:
+        case "xt":
+            control_box_parameters = XtControlBoxParameters()
+        case "micro":
+            control_box_parameters = MicroControlBoxParameters()
+
+    if not 0 <= config.launch_settings.backlighting_level <= control_box_parameters.max_backlighting_level:
+        raise ConfigError(
+            f'launch_settings/Backlight_level outside range {(0, control_box_parameters.max_backlighting_level)}')
+
+    for key, item in config.reading_profiles.items():
+        if not control_box_parameters.min_settling_delay <= item.settling_delay <= control_box_parameters.max_settling_delay:
+            raise ConfigError(
+                f'reading_profiles/{key}/settling_delay outside range {(control_box_parameters.min_settling_delay, control_box_parameters.max_settling_delay)}')
+        if not control_box_parameters.min_max_deviation <= item.max_deviation <= control_box_parameters.max_max_deviation:
+            raise ConfigError(
+                f'reading_profiles/{key}/max_deviation outside range {(control_box_parameters.min_max_deviation, control_box_parameters.max_max_deviation)}')
+
+    return config, devices_specifications, control_box_parameters
+
+
+def create_client(client_config: Client) -> Transport:
+    """Return the transport selected by `client/transport`."""
+    match client_config.transport:
+        case 'tcp':
+            return TcpClient()
+        case 'serial':
+            return SerialClient()
+        case 'in_process':
+            return InProcessClient()
+        case _:
+            return BluetoothClient()
+
+
+def client_address(client_config: Client, devices_specifications: DevicesSpecifications) -> str:
+    """Address passed to the transport `connect`: the mac address (bluetooth), the simulated model
+    (in_process, defaults to the control box model) or `client/address`."""
+    match client_config.transport:
+        case 'bluetooth':
+            return client_config.mac_address
+        case 'in_process':
+            return client_config.address or devices_specifications.control_box.model
+        case _:
+            return client_config.address
+
+
+def find_command_key(key_tables: KeyTables, command: str) -> Optional[int]:
+    """Return the XT controller box internal key value for a given command. (reverse mapping)."""
+    return key_tables.command_keys.get(command)
 
 
 @dataclass
@@ -55,8 +329,9 @@ class InternalBoardState:
     number_of_reading: int = None
 
     firmware: str = None
-    battery_level: str = None
+    battery_level: int = None
     is_charging: bool = None
+    battery_time_to_empty: int = None
     temperature: int = None
     humidity: int = None
     board_stats: str = None
@@ -70,6 +345,92 @@ class InternalBoardState:
     backlighting_sensitivity: int = None
 
 
+READING_PROFILE_SETTINGS = ('stylus_settling_delay', 'stylus_max_deviation', 'number_of_reading')
+
+
+def mode_reading_profile(config: ControllerConfiguration, output_mode: str) -> ReadingProfile:
+    """Reading profile of the `output_mode`."""
+    return config.reading_profiles[config.output_modes.mode_reading_profiles[output_mode]]
+
+
+def desired_board_state(config: ControllerConfiguration, output_mode: str, backlighting_level: int = None
+                        ) -> Dict[str, Any]:
+    """InternalBoardState settings values the board must have to be in sync.
+
+    The launch settings backlighting level is used if `backlighting_level` is None.
+    """
+    reading_profile = mode_reading_profile(config, output_mode)
+    if backlighting_level is None:
+        backlighting_level = config.launch_settings.backlighting_level
+    return {
+        'board_interface': "Dcs5LinkStream",
+        'stylus_status_msg': "disable",  # Could be enabled, but the stylus up/down messages are not used.
+        'stylus_settling_delay': reading_profile.settling_delay,
+        'stylus_max_deviation': reading_profile.max_deviation,
+        'number_of_reading': reading_profile.number_of_reading,
+        'backlighting_level': backlighting_level,
+    }
+
+
+# The functions below call the `c_*` methods of the Dcs5Controller or of the AsyncDcs5Controller and return their
+# results: CommandRequest handles or coroutines to await in order.
+
+def apply_launch_settings(controller: Union['Dcs5Controller', 'AsyncDcs5Controller']):
+    """Set the controller output mode, units, stylus, etc. from the configuration launch settings."""
+    launch_settings = controller.config.launch_settings
+    controller.dynamic_stylus_settings = launch_settings.dynamic_stylus_mode
+    controller.output_mode = launch_settings.output_mode
+    controller.reading_profile = launch_settings.reading_profile
+    controller.length_units = launch_settings.length_units
+    controller.stylus = launch_settings.stylus
+    controller.auto_enter = launch_settings.auto_enter
+    controller.stylus_offset = controller.devices_specifications.stylus_offset[controller.stylus]
+    controller.stylus_cyclical_list = cycle(list(controller.devices_specifications.stylus_offset.keys()))
+
+
+def set_board_setting(controller: Union['Dcs5Controller', 'AsyncDcs5Controller'], name: str, value):
+    """Call the method setting the InternalBoardState field `name` (see `desired_board_state`) to `value`."""
+    match name:
+        case 'board_interface':
+            return controller.c_set_interface({"Dcs5LinkStream": 0, "FEED": 1}[value])
+        case 'stylus_status_msg':
+            return controller.c_set_stylus_detection_message(value == "enable")
+        case 'stylus_settling_delay':
+            return controller.c_set_stylus_settling_delay(value)
+        case 'stylus_max_deviation':
+            return controller.c_set_stylus_max_deviation(value)
+        case 'number_of_reading':
+            return controller.c_set_stylus_number_of_reading(value)
+        case 'backlighting_level':
+            return controller.c_set_backlighting_level(value)
+
+
+def set_output_mode_settings(controller: Union['Dcs5Controller', 'AsyncDcs5Controller']) -> list:
+    """Show the controller output mode on the fuel gauge and, with `dynamic_stylus_settings`, set its reading profile."""
+    results = [controller.c_set_output_mode_fuel_gauge(controller.output_mode)]
+    if controller.dynamic_stylus_settings is True:
+        desired = desired_board_state(controller.config, controller.output_mode)
+        results += [set_board_setting(controller, name, desired[name]) for name in READING_PROFILE_SETTINGS]
+    return results
+
+
+def set_mode_key_backlight_pattern(controller: Union['Dcs5Controller', 'AsyncDcs5Controller'], value: bool) -> list:
+    """Light the MODE key and dim the other keys (`value` True) or restore the backlighting level.
+    Only works for XT models.
+    """
+    if controller.devices_specifications.control_box.model != "xt":
+        return []
+    max_level = controller.control_box_parameters.max_backlighting_level
+    if value is True:
+        if (key := find_command_key(controller.key_tables, 'MODE')) is None:
+            return []
+        return [
+            controller.c_set_backlighting_level(round(max_level / 3), persistent=False),
+            controller.c_set_key_backlighting_level(max_level, key - 1),  # led keys are numbered 0-31 in the firmwares
+        ]
+    return [controller.c_set_backlighting_level(controller.persistent_backlight_level, persistent=True)]
+
+
 class Dcs5Controller:
     dynamic_stylus_settings: bool
     output_mode: str
@@ -94,6 +455,7 @@ class Dcs5Controller:
         self.config: ControllerConfiguration = None
         self.devices_specifications: DevicesSpecifications = None
         self.control_box_parameters: Union[XtControlBoxParameters, MicroControlBoxParameters] = None
+        self.key_tables: KeyTables = None
         self._load_configs()
 
         self.listen_thread: threading.Thread = None
@@ -102,18 +464,22 @@ class Dcs5Controller:
         self.board_state_monitoring_thread: threading.Thread = None
         self.auto_reconnect_thread: threading.Thread = None
         self.auto_reconnect = False
+        self.reconnect_policy = ReconnectPolicy()
+        self._stop_reconnect = threading.Event()
         self.listener_handler_sync_barrier = threading.Barrier(2)
         self.listening_stopped_barrier = threading.Barrier(3)
-        self.ping_event_check = threading.Event()
 
-        self.client = BluetoothClient()
+        self.client: Transport = create_client(self.config.client)
         self.keyboard_emulator = KeyboardEmulator()
         self.internal_board_state = InternalBoardState()  # Board Current State
 
         self.socket_listener = SocketListener(self)
         self.command_handler = CommandHandler(self)
+        self.link_monitor = LinkLivenessMonitor(self)
+        self.telemetry = BoardTelemetryScheduler(self)
 
         self.is_sync = False  # True if the Dcs5Controller board settings are the same as the Board Internal Settings.
+        self.sync_state: Dict[str, bool] = {}  # Per setting (`desired_board_state`) is_sync.
         self.is_listening = False  # listening to the keyboard on the connected socket.
         self.is_muted = False  # Message are processed but keyboard input are suppress.
 
@@ -121,70 +487,44 @@ class Dcs5Controller:
 
         self._set_board_settings()
 
-        self.controller_commands = [
-            "CHANGE_STYLUS",
-            "UNITS_mm",
-            "UNITS_cm",
-            "CHANGE_OUTPUT_MODE",
-            "MODE_TOP",
-            "MODE_LENGTH",
-            "MODE_BOTTOM",
-            "MODE", "BACKLIGHT_UP", "BACKLIGHT_DOWN",
-            "DELETE_LAST"
-            ]
-
         self.marel: MarelController = None
         self.marel_thread: threading.Thread = None
-        self.controller_commands += ["WEIGHT"]
-
-    def _load_configs(self):
-        if (devices_spec := load_devices_specification(self.devices_specifications_path)) is None:
-            raise ConfigError(f'Error in {self.devices_specifications_path}. File could not be loaded.')
-        else:
-            self.devices_specifications = devices_spec
 
-        if (config := load_config(self.config_path)) is None:
-            raise ConfigError(f'Error in {self.config_path}. File could not be loaded.')
-
-        match self.devices_specifications.control_box.model:
-            case "xt":
-                self.control_box_parameters = XtControlBoxParameters()
-            case "micro":
-                self.control_box_parameters = MicroControlBoxParameters()
-
-        if not 0 <= config.launch_settings.backlighting_level <= self.control_box_parameters.max_backlighting_level:
-            raise ConfigError(
-                f'launch_settings/Backlight_level outside range {(0, self.control_box_parameters.max_backlighting_level)}')
-
-        for key, item in config.reading_profiles.items():
-            if not self.control_box_parameters.min_settling_delay <= item.settling_delay <= self.control_box_parameters.max_settling_delay:
-                raise ConfigError(
-                    f'reading_profiles/{key}/settling_delay outside range {(self.control_box_parameters.min_settling_delay, self.control_box_parameters.max_settling_delay)}')
-            if not self.control_box_parameters.min_max_deviation <= item.max_deviation <= self.control_box_parameters.max_max_deviation:
-                raise ConfigError(
-                    f'reading_profiles/{key}/max_deviation outside range {(self.control_box_parameters.min_max_deviation, self.control_box_parameters.max_max_deviation)}')
+        self.controller_commands: Dict[str, Callable] = {
+            "CHANGE_STYLUS": self.cycle_stylus,
+            "UNITS_mm": self.change_length_units_mm,
+            "UNITS_cm": self.change_length_units_cm,
+            "CHANGE_OUTPUT_MODE": self.cycle_output_mode,
+            "MODE_TOP": self._mode_top,
+            "MODE_LENGTH": self._mode_length,
+            "MODE_BOTTOM": self._mode_bottom,
+            "BACKLIGHT_UP": self.backlight_up,
+            "BACKLIGHT_DOWN": self.backlight_down,
+            "WEIGHT": self.marel_get_weight,
+            "DELETE_LAST": self.keyboard_emulator.delete_last
+        }
 
-        self.config = config
+    def _load_configs(self):
+        self.config, self.devices_specifications, self.control_box_parameters = load_controller_configs(
+            self.config_path, self.devices_specifications_path
+        )
+        self.key_tables = self.config.key_maps.compile(self.devices_specifications)
 
     def reload_configs(self):
         self.is_sync = False
         self._load_configs()
         self._set_board_settings()
+        if not self.client.is_connected:
+            self.client.shutdown()
+            self.client = create_client(self.config.client)
 
     def _set_board_settings(self):
-        self.dynamic_stylus_settings = self.config.launch_settings.dynamic_stylus_mode
-        self.output_mode = self.config.launch_settings.output_mode
-        self.reading_profile = self.config.launch_settings.reading_profile
-        self.length_units = self.config.launch_settings.length_units
-        self.stylus: str = self.config.launch_settings.stylus
-        self.auto_enter = self.config.launch_settings.auto_enter
-        self.stylus_offset = self.devices_specifications.stylus_offset[self.stylus]
-        self.stylus_cyclical_list = cycle(list(self.devices_specifications.stylus_offset.keys()))
+        apply_launch_settings(self)
 
     def connect(self):
         """Start Client, initialize and start listening"""
         self.start_client()
-        self.init_controller_and_board()
+        self.sync_board()
         self.start_listening()
 
     def restart(self):
@@ -199,15 +539,32 @@ class Dcs5Controller:
             logging.info("Client Already Connected.")
         else:
             self.is_sync = False  # If the board is Disconnected. Set sync flag to False.
-            self.client.connect(self.config.client.mac_address, timeout=30)
+            self._connect_client()
 
             if self.client.is_connected:
                 self.start_auto_reconnect_thread()
 
+    def _connect_client(self, timeout: float = 30):
+        address = client_address(self.config.client, self.devices_specifications)
+        if self.config.client.transport == 'bluetooth':
+            self.client.connect(address, timeout=timeout, concurrent=True)
+        else:
+            self.client.connect(address, timeout=timeout)
+
+        if self.client.is_connected:
+            self._forget_board_settings()
+
+    def _forget_board_settings(self):
+        """The board may have rebooted since the last connection. Its settings are unknown until sent again."""
+        for name in self.desired_board_state():
+            setattr(self.internal_board_state, name, None)
+        self.sync_state = {}
+
     def close_client(self):
         """"Should only be called from the thread main thread."""
+        self.auto_reconnect = False
+        self._stop_reconnect.set()
         if self.client.is_connected:
-            self.auto_reconnect = False
             self.stop_listening()
             self.client.close()
             logging.info('Client Closed.')
@@ -216,27 +573,56 @@ class Dcs5Controller:
 
     def start_auto_reconnect_thread(self):
         self.auto_reconnect = True
+        self._stop_reconnect.clear()
         self.auto_reconnect_thread = threading.Thread(target=self.monitor_connection,
                                                       name="auto reconnect", daemon=True)
         self.auto_reconnect_thread.start()
         logging.info('Auto Reconnect Thread Started')
 
     def monitor_connection(self):
+        """Wait for the client to be disconnected, reconnect and resume the board state."""
+        resume_listening = False  # Kept until resumed, the connection can be lost again while resuming.
         while self.auto_reconnect is True:
-            while self.client.is_connected:
-                time.sleep(CONNECTION_MONITOR_SLEEP)
-            was_listening = self.is_listening
+            self.client.disconnected.wait()
+            if self.auto_reconnect is not True:
+                break
+
+            logging.info('Connection lost.')
+            self.is_sync = False
+            resume_listening = resume_listening or self.is_listening
             self.stop_listening()
 
-            if self.auto_reconnect is True:
-                while not self.client.is_connected:
-                    logging.info('Attempting to reconnect.')
-                    self.client.connect(self.config.client.mac_address, timeout=30)
-                    time.sleep(.25)
+            if not self._reconnect():
+                break
 
-            if was_listening:
+            if resume_listening:
                 self.start_listening()
-                self.init_controller_and_board()
+                self.sync_board()
+                if self.client.is_connected and self.is_listening:
+                    resume_listening = False
+        logging.info('Auto Reconnect Thread Stopped')
+
+    def _reconnect(self) -> bool:
+        """Reconnect following the `reconnect_policy`. Returns False if stopped or out of budget."""
+        policy = self.reconnect_policy
+        start_time = time.monotonic()
+        for delay in policy.delays():
+            timeout = policy.connect_timeout
+            if policy.budget is not None:
+                timeout = min(timeout, max(policy.budget - (time.monotonic() - start_time), 0.1))
+            logging.info('Attempting to reconnect.')
+            self._connect_client(timeout=timeout)
+            if self.client.is_connected:
+                logging.info(f'Reconnected in {time.monotonic() - start_time:.2f} seconds.')
+                return True
+
+            if policy.budget is not None and time.monotonic() - start_time + delay > policy.budget:
+                logging.error(f'Could not reconnect within {policy.budget} seconds.')
+                self.auto_reconnect = False
+                return False
+            if self._stop_reconnect.wait(delay):
+                return False
+        return False
 
     def start_listening(self):
         if self.client.is_connected:
@@ -244,6 +630,8 @@ class Dcs5Controller:
             if not self.is_listening:
                 logging.info('Starting Threads.')
 
+                self.command_handler.clear_queues()  # Before listening, the commands queued from now on are kept.
+                self.command_handler._reset_window()
                 self.is_listening = True
                 self.command_thread = threading.Thread(target=self.command_handler.processes_queues, name='command handler',
                                                        daemon=True)
@@ -266,6 +654,9 @@ class Dcs5Controller:
     def stop_listening(self):
         if self.is_listening:
             self.is_listening = False
+            self.client.wakeup()
+            self.command_handler.wakeup()
+            self.telemetry.wakeup()
             barrier_value = self.listening_stopped_barrier.wait()
             logging.info(f"Wait Called. Wait value: {barrier_value}.")
 
@@ -280,17 +671,13 @@ class Dcs5Controller:
         self.board_state_monitoring_thread.start()
 
     def monitor_board_state(self):
-        while self.is_listening:
-            self.c_get_battery_level()
-            if self.devices_specifications.control_box.model == "micro":
-                self.c_get_battery_time_to_empty()
-            self.c_get_temperature_humidity()
-            time.sleep(BOARD_STATE_MONITORING_SLEEP)
+        self.telemetry.run()
 
     def unmute_board(self):
         """Unmute board shout output"""
         if self.is_muted:
             self.is_muted = False
+            self.telemetry.wakeup()
             logging.info('Board unmuted')
 
     def mute_board(self):
@@ -312,68 +699,111 @@ class Dcs5Controller:
 
         self.internal_board_state = InternalBoardState()
         self.is_sync = False
+        self.sync_state = {}
         logging.info('Internal Board State Values cleared. is_sync set to False')
 
         was_listening = self.is_listening
         self.restart_listening()
 
-        self.c_set_backlighting_level(0)
-
-        reading_profile = self.config.reading_profiles[
-            self.config.output_modes.mode_reading_profiles[self.output_mode]
+        requests = [self.c_set_backlighting_level(0)]
+        requests += [
+            self._set_board_setting(name, value)
+            for name, value in desired_board_state(self.config, self.output_mode).items()
         ]
+        requests.append(self.c_check_calibration_state())
+        requests.append(self.c_get_board_stats())
 
-        # SET DEFAULT VALUES
-        self.c_set_interface(0)
+        if self.wait_for_commands(requests, timeout=BOARD_SYNC_TIMEOUT) is True:
+            if self._update_sync_state(self.desired_board_state()):
+                logging.info("Board initialization succeeded.")
+            else:
+                logging.info("Board initialization failed.")
+        else:
+            logging.info("Board did not acknowledge the settings. Board initialization failed.")
+
+        if not was_listening:
+            self.stop_listening()
 
-        self.c_set_stylus_detection_message(False) # could be True and it should/would work fine but the up/down msg are not used.
+    def desired_board_state(self) -> Dict[str, Any]:
+        """InternalBoardState settings values the board must have to be in sync."""
+        return desired_board_state(self.config, self.output_mode, self.persistent_backlight_level)
 
-        # SET USER VALUES
-        self.c_set_stylus_settling_delay(reading_profile.settling_delay)
-        self.c_set_stylus_max_deviation(reading_profile.max_deviation)
-        self.c_set_stylus_number_of_reading(reading_profile.number_of_reading)
+    def _set_board_setting(self, name: str, value) -> Optional['CommandRequest']:
+        """Queue the command setting the InternalBoardState field `name` to `value`."""
+        return set_board_setting(self, name, value)
 
-        self.c_set_backlighting_level(self.config.launch_settings.backlighting_level)
+    def _update_sync_state(self, desired: Dict[str, Any]) -> bool:
+        """Compare the InternalBoardState with `desired`, field by field. Sets `sync_state` and `is_sync`."""
+        self.sync_state = {
+            name: getattr(self.internal_board_state, name) == value for name, value in desired.items()
+        }
+        self.is_sync = all(self.sync_state.values())
+        if not self.is_sync:
+            logging.debug(f"Board settings not in sync: {[name for name, is_sync in self.sync_state.items() if not is_sync]}")
+        return self.is_sync
 
-        self.c_check_calibration_state()
-        self.c_get_board_stats()
+    def sync_board(self):
+        """Send only the board settings that differ from the InternalBoardState.
 
-        if self.wait_for_initialization_ping(timeout=5) is True:
-            if (
-                    self.internal_board_state.board_interface == "Dcs5LinkStream" and
-                    self.internal_board_state.stylus_status_msg == "disable" and
-                    self.internal_board_state.stylus_settling_delay == reading_profile.settling_delay and
-                    self.internal_board_state.stylus_max_deviation == reading_profile.max_deviation and
-                    self.internal_board_state.number_of_reading == reading_profile.number_of_reading and
-                    self.internal_board_state.backlighting_level == self.persistent_backlight_level
-            ):
-                self.is_sync = True
-                logging.info("Board initialization succeeded.")
+        Used on connection and reconnection. The board settings cannot be queried and are lost when the board
+        reboots, so they are unknown on a new connection (see `_forget_board_settings`) and all sent. Within a
+        connection, the InternalBoardState is the last state confirmed by the board. The board stats and
+        calibration state are queried first to check that the board answers and that it is the same board
+        (firmware).
+
+        Falls back to `init_controller_and_board` if the board does not answer or is still not in sync.
+        """
+        logging.info('Synchronizing Board.')
+        self.is_sync = False
+        if not self.client.is_connected:
+            return
+
+        state = self.internal_board_state
+        was_listening = self.is_listening
+        self.start_listening()
+
+        firmware = state.firmware
+        deadline = time.monotonic() + BOARD_SYNC_TIMEOUT
+        requests = [self.c_get_board_stats(), self.c_check_calibration_state()]
+        if self.wait_for_commands(requests, timeout=BOARD_SYNC_TIMEOUT) is True and firmware in (None, state.firmware):
+            desired = self.desired_board_state()
+            requests = [
+                self._set_board_setting(name, value)
+                for name, value in desired.items() if getattr(state, name) != value
+            ]
+            logging.info(f'Board settings to update: {len(requests)}.')
+            if self.wait_for_commands(requests, timeout=max(deadline - time.monotonic(), 0)) is True \
+                    and self._update_sync_state(desired):
+                logging.info("Board synchronized.")
+            elif not self.client.is_connected:
+                logging.info("Connection lost. Board could not be synchronized.")
             else:
-                logging.info("Board initialization failed.")
-                state = [
-                    self.internal_board_state.sensor_mode,
-                    self.internal_board_state.stylus_status_msg,
-                    (self.internal_board_state.stylus_settling_delay, reading_profile.settling_delay),
-                    (self.internal_board_state.stylus_max_deviation, reading_profile.max_deviation),
-                    (self.internal_board_state.number_of_reading, reading_profile.number_of_reading),
-                    (self.internal_board_state.backlighting_level, self.persistent_backlight_level)]
-                logging.debug(f"Board state after initialization: {state}")
+                logging.info("Board could not be synchronized. Initializing Board.")
+                self.init_controller_and_board()
+        elif not self.client.is_connected:
+            logging.info("Connection lost. Board could not be synchronized.")
         else:
-            logging.info("Ping was not received. Board initialization failed.")
+            logging.info("Board stats not received or board changed. Initializing Board.")
+            self.init_controller_and_board()
 
         if not was_listening:
             self.stop_listening()
 
-    def wait_for_initialization_ping(self, timeout=2):
-        self.c_ping()
-        self.ping_event_check.clear()
-        logging.info('Waiting for ping event.')
-        if self.ping_event_check.wait(timeout):
-            logging.info('Initializing Ping received.')
-            return True
-        logging.info('Initializing Ping not received.')
-        return False
+    def wait_for_commands(self, requests: List[Optional['CommandRequest']], timeout: float = None) -> bool:
+        """Wait until all the `requests` are done (acknowledged, timed out or cancelled).
+
+        Without `timeout`, waits as long as the slowest command including its retries.
+        Returns True if all the commands were acknowledged with the expected replies.
+        None requests (e.g. setting values out of range) count as failed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for request in requests:
+            if request is None:
+                return False
+            if not request.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+                logging.info(f'Command {[request.command]} failed: {request.error or "timeout"}.')
+                return False
+        return True
 
     def change_length_units_mm(self, flash=True):
         self.length_units = "mm"
@@ -397,33 +827,12 @@ class Dcs5Controller:
     def set_mode_key_backlight_pattern(self, value: bool):
         """Only works for XT models.
         """
-        if self.is_listening and self.devices_specifications.control_box.model == "xt":
-            if value is True:
-                key = self.find_command_key('MODE')
-                if key is not None:
-                    key -= 1  # led keys are numbered 0-31 in the firmwares
-                    self.c_set_backlighting_level(round(self.control_box_parameters.max_backlighting_level / 3), persistent=False)
-                    self.c_set_key_backlighting_level(level=self.control_box_parameters.max_backlighting_level, key=key)
-            else:
-                self.c_set_backlighting_level(self.persistent_backlight_level, persistent=True)
+        if self.is_listening:
+            set_mode_key_backlight_pattern(self, value)
 
     def find_command_key(self, command: str):
         """Return the XT controller box internal key value for a given command. (reverse mapping)."""
-        _key = None
-        for key in self.config.key_maps.control_box:
-            for value in (self.config.key_maps.control_box[key], self.config.key_maps.control_box_mode[key]):
-                if isinstance(value, str):
-                    if command == value:
-                        _key = key
-                        break
-                else:
-                    if command in value:
-                        _key = key
-                        break
-        if _key is not None:
-            return int(dict(zip(self.devices_specifications.control_box.keys_layout.values(),
-                            self.devices_specifications.control_box.keys_layout.keys()))[_key])
-        return None
+        return find_command_key(self.key_tables, command)
 
     def cycle_stylus(self):
         self.change_stylus(next(self.stylus_cyclical_list))
@@ -436,30 +845,7 @@ class Dcs5Controller:
         """
         self.output_mode = value
         if self.client.is_connected:
-            if self.is_listening:  # and flash is True:
-                if self.devices_specifications.control_box.model == "xt":
-                    if self.output_mode == 'bottom':
-                        self.c_set_fuel_gauge(int("00001111", 2))
-                    elif self.output_mode == 'top':
-                        self.c_set_fuel_gauge(int("11110000", 2))
-                    else:
-                        self.c_set_fuel_gauge(int("00111100", 2))
-                else:
-                    color = [int('FF', 16), int('60', 16), int('00', 16), int('00', 16)] #  orange
-                    if self.output_mode == 'bottom':
-                        self.c_set_fuel_gauge(int("11000000", 2), color)
-                    elif self.output_mode == 'top':
-                        self.c_set_fuel_gauge(int("00001100", 2), color)
-                    else:
-                        self.c_set_fuel_gauge(int("00000011", 2), color)
-
-            if self.dynamic_stylus_settings is True:
-                reading_profile = self.config.reading_profiles[
-                    self.config.output_modes.mode_reading_profiles[self.output_mode]
-                ]
-                self.c_set_stylus_settling_delay(reading_profile.settling_delay)
-                self.c_set_stylus_max_deviation(reading_profile.max_deviation)
-                self.c_set_stylus_number_of_reading(reading_profile.number_of_reading)
+            set_output_mode_settings(self)
         logging.info(f'Board entry: {self.output_mode}.')
 
     def _mode_top(self):
@@ -473,7 +859,8 @@ class Dcs5Controller:
 
     def to_keyboard(self, value: Union[int, float, str]):
         if not self.is_muted:
-            logging.info(f"Writing value: {value}")
+            if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                wire_logger.info('Writing value: %s', value)
             self.keyboard_emulator.write(value)
 
     def backlight_up(self):
@@ -495,20 +882,7 @@ class Dcs5Controller:
             logging.info("Backlighting is already at minimum.")
 
     def mapped_controller_commands(self, command: str):
-        commands = {
-            "CHANGE_STYLUS": self.cycle_stylus,
-            "UNITS_mm": self.change_length_units_mm,
-            "UNITS_cm": self.change_length_units_cm,
-            "CHANGE_OUTPUT_MODE": self.cycle_output_mode,
-            "MODE_TOP": self._mode_top,
-            "MODE_LENGTH": self._mode_length,
-            "MODE_BOTTOM": self._mode_bottom,
-            "BACKLIGHT_UP": self.backlight_up,
-            "BACKLIGHT_DOWN": self.backlight_down,
-            "WEIGHT": self.marel_get_weight,
-            "DELETE_LAST": self.keyboard_emulator.delete_last
-        }
-        commands[command]()
+        self.controller_commands[command]()
 
     def calibrate(self, pt: int) -> int:
         """
@@ -557,25 +931,35 @@ class Dcs5Controller:
                 self.start_listening()
 
     def c_ping(self):
-        self.command_handler.queue_command("&a#", "%a#\r")
+        return self.command_handler.queue_command(*protocol.ping(), priority=PRIORITY_INTERACTIVE)
 
     def c_get_board_stats(self):
-        self.command_handler.queue_command("b#", "regex_%b.*#\r")
+        return self.command_handler.queue_command(*protocol.get_board_stats(), retries=COMMAND_RETRIES)
 
     def c_get_battery_level(self):
-        self.command_handler.queue_command('&q#', "regex_%q:\d+,\d+#\r")
+        return self.command_handler.queue_command(
+            *protocol.get_battery_level(), retries=COMMAND_RETRIES, priority=PRIORITY_BACKGROUND
+        )
 
     def c_get_battery_time_to_empty(self):
         """Micro Only"""
-        self.command_handler.queue_command('&qe#', "regex_%qe:\d+#\r")
+        return self.command_handler.queue_command(
+            *protocol.get_battery_time_to_empty(), retries=COMMAND_RETRIES, priority=PRIORITY_BACKGROUND
+        )
 
     def c_get_temperature_humidity(self):
-        self.command_handler.queue_command('&t#', "regex_%t,\d+,\d+#\r")
+        return self.command_handler.queue_command(
+            *protocol.get_temperature_humidity(), retries=COMMAND_RETRIES, priority=PRIORITY_BACKGROUND
+        )
 
     def c_board_initialization(self):
-        self.command_handler.queue_command("&init#", ["Setting EEPROM init flag.\r", "Rebooting in 2 seconds.\r"])
+        request = self.command_handler.queue_command(*protocol.board_initialization())
         time.sleep(1)
         self.close_client()
+        self.internal_board_state = InternalBoardState()  # The board settings are reset.
+        self.is_sync = False
+        self.sync_state = {}
+        return request
 
     def c_set_interface(self, value: int):
         """
@@ -583,12 +967,13 @@ class Dcs5Controller:
         -----
           Only the DCS5Linkstream Interface is now supported.
         """
-        host_app = {0: 'DCSLinkstream', 1: "FEED"}[value]
-        self.command_handler.queue_command(f"&pl,{value}#", [f'HostApp={host_app}\r', f"%pl,{value}#\r"])
+        return self.command_handler.queue_command(
+            *protocol.set_interface(value), retries=COMMAND_RETRIES, coalesce_key='pl'
+        )
 
     def c_flash_fuel_gauge(self):
         """For the Micro the fuel gauge is the led rings."""
-        self.command_handler.queue_command("&ra#", "%ra#\r")
+        return self.command_handler.queue_command(*protocol.flash_fuel_gauge(), priority=PRIORITY_INTERACTIVE)
 
     def c_set_fuel_gauge(self, value: int, color: list = None):
         """For the Micro the fuel gauge is the led rings.
@@ -600,12 +985,11 @@ class Dcs5Controller:
             (r, g, b, w) Int representing hex value color value.
         """
         if self.devices_specifications.control_box.model == 'xt':
-            self.command_handler.queue_command(f"&lf,{value}#", f"%lf,{value}#\r")
-        else:
-            color = list(map(str, color))
-            self.command_handler.queue_command(
-                f"&lf,{value},{','.join(color)}#", f"%lf,{value},{','.join(color)}#\r"
-            )
+            color = None
+        return self.command_handler.queue_command(
+            *protocol.set_fuel_gauge(value, color),
+            retries=COMMAND_RETRIES, coalesce_key='lf', priority=PRIORITY_INTERACTIVE
+        )
 
     def c_set_fuel_gauge_temporary(self, delay: int, value: int, color: list = None):
         """For the Micro the fuel gauge is the led rings.
@@ -620,21 +1004,29 @@ class Dcs5Controller:
             (r, g, b, w) Int representing hex value color value.
         """
         if self.devices_specifications.control_box.model == 'xt':
-            self.command_handler.queue_command(f"&lt,{delay},{value}#", f"%lt,{delay},{value}#\r")
-        else:
-            color = list(map(str, color))
-            self.command_handler.queue_command(
-                f"&lt,{delay},{value},{','.join(color)}#", f"%lt,{delay},{value},{','.join(color)}#\r"
-            )
+            color = None
+        return self.command_handler.queue_command(
+            *protocol.set_fuel_gauge_temporary(delay, value, color), priority=PRIORITY_INTERACTIVE
+        )
+
+    def c_set_output_mode_fuel_gauge(self, output_mode: str):
+        """Show `output_mode` on the fuel gauge (XT) or on the led rings (Micro)."""
+        return self.command_handler.queue_command(
+            *protocol.set_output_mode_fuel_gauge(self.devices_specifications.control_box.model, output_mode),
+            retries=COMMAND_RETRIES, coalesce_key='lf', priority=PRIORITY_INTERACTIVE
+        )
 
     def c_set_backlighting_level(self, level: int, persistent=True):
         if level is None:
             level = self.control_box_parameters.max_backlighting_level
 
         if 0 <= level <= self.control_box_parameters.max_backlighting_level:
-            self.command_handler.queue_command(f'&la,{level}#', f"%la,{level}#\r")
             if persistent is True:
                 self.persistent_backlight_level = level
+            return self.command_handler.queue_command(
+                *protocol.set_backlighting_level(level),
+                retries=COMMAND_RETRIES, coalesce_key='la', priority=PRIORITY_INTERACTIVE
+            )
         else:
             logging.warning(f"Backlighting level range: (0, {self.control_box_parameters.max_backlighting_level})")
 
@@ -642,7 +1034,10 @@ class Dcs5Controller:
         if level is None:
             level = self.control_box_parameters.max_backlighting_level
         if 0 <= level <= self.control_box_parameters.max_backlighting_level:
-            self.command_handler.queue_command(f'&lk,{level},{key}#', f"%lk,{level},{key}#\r")
+            return self.command_handler.queue_command(
+                *protocol.set_key_backlighting_level(level, key), retries=COMMAND_RETRIES, coalesce_key=f'lk,{key}',
+                priority=PRIORITY_INTERACTIVE
+            )
         else:
             logging.warning(f"Backlighting level range: (0, {self.control_box_parameters.max_backlighting_level})")
 
@@ -656,37 +1051,45 @@ class Dcs5Controller:
         """
         When disabled (false): %t0 %t1 are not sent
         """
-        self.command_handler.queue_command(f'&sn,{int(value)}#', f'%sn:{int(value)}#\r')
+        return self.command_handler.queue_command(
+            *protocol.set_stylus_detection_message(value), retries=COMMAND_RETRIES, coalesce_key='sn'
+        )
 
     def c_set_stylus_settling_delay(self, value: int = 1):
         if self.control_box_parameters.min_settling_delay <= value <= self.control_box_parameters.max_settling_delay:
-            self.command_handler.queue_command(f"&di,{value}#", f"%di:{value}#\r")
+            return self.command_handler.queue_command(
+                *protocol.set_stylus_settling_delay(value), retries=COMMAND_RETRIES, coalesce_key='di'
+            )
         else:
             logging.warning(
                 f"Settling delay value range: ({self.control_box_parameters.min_settling_delay}, {self.control_box_parameters.max_settling_delay})")
 
     def c_set_stylus_max_deviation(self, value: int):
         if self.control_box_parameters.min_max_deviation <= value <= self.control_box_parameters.max_max_deviation:
-            self.command_handler.queue_command(f"&dm,{value}#", f"%dm:{value}#\r")
+            return self.command_handler.queue_command(
+                *protocol.set_stylus_max_deviation(value), retries=COMMAND_RETRIES, coalesce_key='dm'
+            )
         else:
             logging.warning(
                 f"Settling delay value range: ({self.control_box_parameters.min_max_deviation}, {self.control_box_parameters.max_max_deviation})")
 
     def c_set_stylus_number_of_reading(self, value: int = 5):
-        self.command_handler.queue_command(f"&dn,{value}#", f"%dn:{value}#\r")
+        return self.command_handler.queue_command(
+            *protocol.set_stylus_number_of_reading(value), retries=COMMAND_RETRIES, coalesce_key='dn'
+        )
 
     def c_restore_cal_data(self):
-        self.command_handler.queue_command("&cr,m1,m2,raw1,raw2#", None)
+        return self.command_handler.queue_command(*protocol.restore_cal_data())
 
     def c_clear_cal_data(self):
-        self.command_handler.queue_command("&ca#", None)
         self.internal_board_state.calibrated = False
+        return self.command_handler.queue_command(*protocol.clear_cal_data())
 
     def c_check_calibration_state(self):
-        self.command_handler.queue_command('&u#', 'regex_%u:\d#\r')
+        return self.command_handler.queue_command(*protocol.check_calibration_state(), retries=COMMAND_RETRIES)
 
     def c_set_calibration_points_mm(self, pt: int, pos: int):
-        self.command_handler.queue_command(f'&{pt}mm,{pos}#', f'%{pt}mm,{pos}#\r')
+        return self.command_handler.queue_command(*protocol.set_calibration_points_mm(pt, pos), retries=COMMAND_RETRIES)
 
     def start_marel_listening(self):
         logging.info(f'starting Marel: {self.config.client.marel_ip_address}')
@@ -718,44 +1121,256 @@ class Dcs5Controller:
                     self.to_keyboard('enter')
 
 
+REPLY_OPCODE_PATTERN = re.compile(r"%\d*([a-zA-Z]+)|(Cal Pt)")  # e.g. `%qe:...` -> `qe`, `%1mm,...` -> `mm`.
+REPLY_KEY_PATTERN = re.compile(r"%\d*([a-zA-Z]+)|([a-zA-Z]+)")
+REPLY_HANDLERS: Dict[str, Tuple[re.Pattern, Callable[['CommandHandler', re.Match], None]]] = {}
+
+
+def reply_handler(opcode: str, pattern: str):
+    """Register a CommandHandler method as the handler of the board replies with `opcode`.
+
+    Parameters
+    ----------
+    opcode :
+        Letters following the `%` of the reply (digits are skipped). e.g. `pl` for `%pl,0#`.
+    pattern :
+        Regular expression matched at the start of the reply. The match is passed to the handler.
+    """
+    def decorator(method):
+        REPLY_HANDLERS[opcode] = (re.compile(pattern), method)
+        return method
+    return decorator
+
+
+def reply_key(message: str) -> Optional[str]:
+    """Return the key used to match a reply with its command: the opcode of `%` replies
+    (e.g. `la` for `%la,95#`), else the first word (e.g. `HostApp` for `HostApp=DCSLinkstream`).
+
+    Expected replies starting with `regex_` are keyed on the regular expression.
+    """
+    if message.startswith('regex_'):
+        message = message[len('regex_'):]
+    if (match := REPLY_KEY_PATTERN.match(message)) is not None:
+        return match[1] or match[2]
+    return None
+
+
+class CommandRequest:
+    """Handle of a command queued with `CommandHandler.queue_command`.
+
+    The request is done when all the expected replies are received, when it is still not answered
+    after `retries` resends (`timeout` seconds each) or when it is cancelled (listening stopped).
+    The command of a coalesced setting (`coalesce_key`) is replaced by the latest one queued before it is sent
+    and the request is moved behind the commands queued in between.
+    """
+    def __init__(self, command: str, expected: List[str], timeout: float, retries: int, coalesce_key: str = None,
+                 priority: int = PRIORITY_CONFIGURATION):
+        self.command = command
+        self.expected = expected
+        self.expected_keys = [reply_key(message) for message in expected]
+        self.timeout = timeout
+        self.retries = retries
+        self.coalesce_key = coalesce_key
+        self.priority = priority
+        self.queued_time = time.monotonic()
+        self.replies: List[str] = []
+        self.attempts = 0
+        self.deadline: float = None
+        self.error: str = None  # `unexpected`, `timeout` or `cancelled`
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return f"CommandRequest({self.command!r}, replies={self.replies}, error={self.error})"
+
+    @property
+    def next_reply_key(self) -> Optional[str]:
+        return self.expected_keys[len(self.replies)] if len(self.replies) < len(self.expected) else None
+
+    @property
+    def succeeded(self) -> bool:
+        return self._done.is_set() and self.error is None
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the request is done. Returns True if all the expected replies were received."""
+        self._done.wait(timeout)
+        return self.succeeded
+
+    def finish(self, error: str = None):
+        if self.error is None:
+            self.error = error
+        self._done.set()
+
+
+@dataclass
+class CommandMetrics:
+    """Counters of the CommandHandler. `timeouts_per_command` is keyed by the command opcode (e.g. `la`)."""
+    window_size: int = 0
+    in_flight: int = 0
+    sent: int = 0
+    acknowledged: int = 0
+    unexpected: int = 0
+    timeouts: int = 0
+    retries: int = 0
+    coalesced: int = 0
+    timeouts_per_command: Dict[str, int] = field(default_factory=dict)
+
+
 class CommandHandler:
+    """Sends the queued commands and matches the board replies with the commands sent.
+
+    Replies are matched by key (see `reply_key`) with the oldest command sent waiting for that reply,
+    so a lost or unsolicited reply only affects a single command.
+
+    At most `window_size` commands are awaiting a reply at once. The window grows by one command per
+    window of acknowledged commands, up to `max_commands_in_flight` (control box parameters), and is
+    halved on timeouts and unexpected replies.
+
+    Idempotent settings are coalesced by `coalesce_key`: only the latest value queued is sent.
+
+    Commands are queued by priority (`COMMAND_PRIORITIES`) and the highest priority commands are sent first.
+    Background commands are sent only while the stylus is idle (see `SocketListener.time_until_stylus_idle`)
+    or once they have been deferred for `BACKGROUND_MAX_DEFERRAL` seconds.
+
+    The handler thread sleeps on `condition` until a command is queued, a reply is received
+    (`put_received`), a command times out or `wakeup` is called (e.g. when listening stops).
+    """
     def __init__(self, controller: Dcs5Controller):
         self.controller = controller
 
-        self.send_queue = Queue()
+        # One queue per priority. Accessed with the `condition` lock held.
+        self.send_queues: Tuple[Deque[CommandRequest], ...] = tuple(deque() for _ in COMMAND_PRIORITIES)
         self.received_queue = Queue()
-        self.expected_message_queue = Queue()
+        self.in_flight: List[CommandRequest] = []  # Sent and waiting for replies. Handler thread only.
+        self._unsent_settings: Dict[str, CommandRequest] = {}  # coalesce_key -> request in a send queue.
+        self.condition = threading.Condition()
+        self._last_sent_time = 0
+        self._window: float = 1
+        self.metrics = CommandMetrics()
+
+    def queue_command(self, command: str, message: Union[str, List[str]] = None,
+                      timeout: float = COMMAND_TIMEOUT, retries: int = 0, coalesce_key: str = None,
+                      priority: int = PRIORITY_CONFIGURATION) -> CommandRequest:
+        """
+        Parameters
+        ----------
+        command :
+            Command sent to the board.
+        message :
+            Expected reply or replies. Expected replies starting with `regex_` are matched as regular expression.
+        timeout :
+            Seconds to wait for the replies after the command is sent.
+        retries :
+            Number of times the command is sent again on timeout. Only for idempotent commands.
+        coalesce_key :
+            Key of an idempotent setting (e.g. `la`). If a command with the same key is still waiting to be sent,
+            its command and expected replies are replaced by these ones, it is moved to the end of the `priority`
+            queue (after the commands queued since) and its handle is returned.
+        priority :
+            One of `COMMAND_PRIORITIES`.
 
-    def queue_command(self, command: str, message: Union[str, List[str]] = None):
-        if message is not None:
-            if isinstance(message, list):
-                [self.expected_message_queue.put(msg) for msg in message]
+        Returns
+        -------
+        The request handle. Use `CommandRequest.wait()` to wait for the replies.
+        The request is cancelled if the controller is not listening or the client is not connected.
+        """
+        expected = [] if message is None else message if isinstance(message, list) else [message]
+        with self.condition:
+            if (request := self._unsent_settings.get(coalesce_key)) is not None:  # Latest value wins.
+                request.command, request.expected = command, expected
+                request.expected_keys = [reply_key(message) for message in expected]
+                request.timeout, request.retries = timeout, retries
+                if request.priority != priority or self.send_queues[priority][-1] is not request:
+                    self.send_queues[request.priority].remove(request)  # Sent in the order it was last queued.
+                    request.priority = priority
+                    self.send_queues[priority].append(request)
+                    self.condition.notify_all()
+                self.metrics.coalesced += 1
             else:
-                self.expected_message_queue.put(message)
-        self.send_queue.put(command)
-        logging.info(f'Queuing: Command -> {[command]}, Expected -> {[message]}')
+                request = CommandRequest(command, expected, timeout, retries, coalesce_key, priority)
+                if not (self.controller.is_listening and self.controller.client.is_connected):
+                    request.finish('cancelled')
+                    return request
+                if coalesce_key is not None:
+                    self._unsent_settings[coalesce_key] = request
+                self.send_queues[priority].append(request)
+                self.condition.notify_all()
+        if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+            wire_logger.info('Queuing: Command -> %r, Expected -> %r', command, message)
+        return request
+
+    def put_received(self, received: str):
+        """Queue a board reply for the handler thread."""
+        self.received_queue.put(received)
+        self.wakeup()
+
+    def wakeup(self):
+        with self.condition:
+            self.condition.notify_all()
 
     def clear_queues(self):
-        self.send_queue.queue.clear()
+        with self.condition:
+            for send_queue in self.send_queues:
+                for request in send_queue:
+                    request.finish('cancelled')
+                send_queue.clear()
+            self._unsent_settings.clear()
         self.received_queue.queue.clear()
-        self.expected_message_queue.queue.clear()
+        self._cancel_in_flight()
         logging.info("Handler Queues Cleared.")
 
+    def _cancel_in_flight(self):
+        for request in self.in_flight:
+            request.finish('cancelled')
+        self.in_flight.clear()
+        self.metrics.in_flight = 0
+
+    @property
+    def window_size(self) -> int:
+        return int(self._window)
+
+    def _reset_window(self):
+        self._window = self.controller.control_box_parameters.max_commands_in_flight
+        self.metrics.window_size = self.window_size
+
+    def _grow_window(self):
+        max_window = self.controller.control_box_parameters.max_commands_in_flight
+        self._window = min(self._window + 1 / self._window, max_window)
+        self.metrics.window_size = self.window_size
+
+    def _shrink_window(self):
+        self._window = max(self._window / 2, 1)
+        self.metrics.window_size = self.window_size
+        logging.debug(f'Command window reduced to {self.window_size}.')
+
     def processes_queues(self):
-        self.clear_queues()
         logging.debug('listener_handler_sync_barrier set.')
         self.controller.listener_handler_sync_barrier.wait()
         logging.info('Command Handling Started')
         while self.controller.is_listening:
+            with self.condition:
+                while self.controller.is_listening and self.received_queue.empty():
+                    if (timeout := self._time_until_next_event()) is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
 
-            if not self.received_queue.empty():
+            while not self.received_queue.empty():
                 self._process_commands()
 
-            if not self.send_queue.empty():
-                self._send_command()
-                time.sleep(AFTER_SENT_SLEEP)
+            if not self.controller.client.is_connected:  # Nothing can be sent or answered until reconnected.
+                if self.in_flight or any(self.send_queues):
+                    logging.info('Client disconnected. Pending commands cancelled.')
+                    self.clear_queues()
+                continue
+
+            self._check_timeouts()
 
-            time.sleep(HANDLER_SLEEP)
+            if self._can_send() and self._time_until_next_write() <= 0:
+                self._send_commands()
+
+        self.clear_queues()  # Cancels the pending commands.
         logging.debug('listener_handler stop barrier set.')
         self.controller.listening_stopped_barrier.wait()
         logging.info('Command Handling Stopped')
@@ -763,268 +1378,362 @@ class CommandHandler:
     def _process_commands(self):
         received = self.received_queue.get()
 
-        self._compared_with_expected(received)
-
-        if "%a#" in received:
-            self.controller.ping_event_check.set()
-            logging.info('Ping command was received. Ping event is set.')
-
-        elif "%pl," in received:
-            match = re.findall(f"%pl,(\d)#\r", received)
-            if len(match) > 0:
-                if match[0] == "0":
-                    self.controller.internal_board_state.board_interface = "Dcs5LinkStream"
-                    logging.info(f'Interface set to DcsLinkStream')
-                elif match[0] == "1":
-                    self.controller.internal_board_state.board_interface = "FEED"
-                    logging.info(f'Interface set to FEED')
-
-        elif "%sn:" in received:
-            match = re.findall(f"%sn:(\d)#\r", received)
-            if len(match) > 0:
-                if match[0] == "1":
-                    self.controller.internal_board_state.stylus_status_msg = "enable"
-                    logging.info('Stylus Status Message Enable')
-                else:
-                    self.controller.internal_board_state.stylus_status_msg = "disable"
-                    logging.info('Stylus Status Message Disable')
-
-        elif "%di:" in received:
-            match = re.findall(f"%di:(\d+)#\r", received)
-            if len(match) > 0:
-                self.controller.internal_board_state.stylus_settling_delay = int(match[0])
-                logging.info(f"Stylus settling delay set to {match[0]}")
-
-        elif "%dm:" in received:
-            match = re.findall(f"%dm:(\d+)#\r", received)
-            if len(match) > 0:
-                self.controller.internal_board_state.stylus_max_deviation = int(match[0])
-                logging.info(f"Stylus max deviation set to {int(match[0])}")
-
-        elif "%dn:" in received:
-            match = re.findall(f"%dn:(\d+)#\r", received)
-            if len(match) > 0:
-                self.controller.internal_board_state.number_of_reading = int(match[0])
-                logging.info(f"Stylus number set to {int(match[0])}")
-
-        elif "%b:" in received:
-            match = re.findall("%b:(.*)#", received)
-            if len(match) > 0:
-                logging.info(f'Board State: {match[0]}')
-                self.controller.internal_board_state.board_stats = match[0]
-                firmware_version = match[0].split(',')[1]
-                self.controller.internal_board_state.firmware = firmware_version[:-2] + '.' + firmware_version[-2:]
-
-        elif "%q:" in received:
-            match = re.findall("%q:(\d+),(\d+)#", received)
-            if len(match) > 0:
-                logging.info(f'Battery level: {match[0][0]}')
-                self.controller.internal_board_state.battery_level = int(match[0][0])
-                if self.controller.devices_specifications.control_box.model == "xt":
-                    self.controller.internal_board_state.is_charging = bool(int(match[0][1]))
-
-        elif "%qe:" in received:
-            match = re.findall("%qe:(\d+)#", received)
-            if len(match) > 0:
-                logging.info(f'Battery time to empty: {match[0]}')
-                if int(match[0]) == 65535:
-                    self.controller.internal_board_state.is_charging = True
-                else:
-                    self.controller.internal_board_state.is_charging = False
-
-        elif "%t," in received:
-            match = re.findall("%t,(\d+),(\d+)#", received)
-            if len(match) > 0:
-                logging.info(f'temperature: {match[0][0]}, humidity: {match[0][1]}')
-                self.controller.internal_board_state.temperature = int(match[0][0])
-                self.controller.internal_board_state.humidity = int(match[0][1])
-
-        elif "%u:" in received:
-            match = re.findall("%u:(\d)#", received)
-            if len(match) > 0:
-                if match[0] == '0':
-                    logging.info('Board is not calibrated.')
-                    self.controller.internal_board_state.calibrated = False
-                elif match[0] == '1':
-                    logging.info('Board is calibrated.')
-                    self.controller.internal_board_state.calibrated = True
+        self._match_reply(received)
+
+        self.update_board_state(received)
+
+    def _match_reply(self, received: str):
+        """Match `received` with the oldest command sent expecting this reply, else with the oldest command
+        waiting for a reply with the same key. Commands with the same key are pipelined when the window is
+        larger than 1, so a lost reply must not be attributed to the next one.
+        """
+        key = reply_key(received)
+        pending = [request for request in self.in_flight if request.next_reply_key == key]
+        if not pending:
+            rate_limited_log.error('unexpected_reply', 'Unexpected: Command received: %r. No command pending.', received)
+            return
+        request = next(
+            (r for r in pending if self.is_expected(received, r.expected[len(r.replies)])), pending[0]
+        )
+
+        expected = request.expected[len(request.replies)]
+        request.replies.append(received)
+        if self.is_expected(received, expected):
+            if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                wire_logger.info('Command Valid. Received: %r', received)
+        else:
+            rate_limited_log.error(
+                'unexpected_reply', 'Unexpected: Command received: %r, Command expected: %r', received, expected
+            )
+            request.error = 'unexpected'
+            self.metrics.unexpected += 1
+            self._shrink_window()
+
+        if len(request.replies) == len(request.expected):
+            self.in_flight.remove(request)
+            self.metrics.in_flight = len(self.in_flight)
+            if request.error is None:
+                self.metrics.acknowledged += 1
+                self._grow_window()
+            request.finish()
+
+    def _check_timeouts(self):
+        """Send the timed out commands again or finish them if they have no retries left."""
+        now = time.monotonic()
+        if not (timed_out := [r for r in self.in_flight if r.deadline <= now]):
+            return
+        self._shrink_window()  # Once per check, the timeouts are likely caused by the same overrun.
+        for request in timed_out:
+            self.in_flight.remove(request)
+            self.metrics.timeouts += 1
+            opcode = request.expected_keys[0]
+            self.metrics.timeouts_per_command[opcode] = self.metrics.timeouts_per_command.get(opcode, 0) + 1
+            if request.attempts <= request.retries:
+                self.metrics.retries += 1
+                logging.warning(f'No reply to {[request.command]}. Sending it again ({request.attempts}/{request.retries}).')
+                request.replies.clear()
+                request.error = None
+                with self.condition:  # Sent again before the other commands of the same priority.
+                    self.send_queues[request.priority].appendleft(request)
             else:
-                logging.error(f'Calibration state {received}')
-
-        elif "%la," in received:
-            match = re.findall("%la,(\d+)#", received)
-            if len(match) > 0:
-                level = int(match[0])
-                self.controller.internal_board_state.backlighting_level = level
-                logging.info(f'Backlight level set to {level}')
-
-        elif 'Cal Pt' in received:
-            logging.info(received.strip("\r") + " mm")
-            match = re.findall("Cal Pt (\d+) set to: (\d+)", received)  # used to work on firmwares v1.07 (I think) of XT.
-            if len(match) > 0:
-                self.controller.internal_board_state.__dict__[f'cal_pt_{match[0][0]}'] = int(match[0][1])
-
-        elif 'mm' in received:
-            logging.info(received.strip("\r") + " mm")
-            match = re.findall(f'%(\d+)mm,(\d+)#\r', received)
-            if len(match) > 0:
-                self.controller.internal_board_state.__dict__[f'cal_pt_{match[0][0]}'] = int(match[0][1])
-
-    def _compared_with_expected(self, received: str):
-        command_is_valid = False
-        expected = self.expected_message_queue.get()
-        logging.info(f'Received: {[received]}, Expected: {[expected]}')
+                rate_limited_log.error(
+                    'command_timeout', 'Reply to %r not received. Expected: %r', request.command, request.expected
+                )
+                request.finish('timeout')
 
-        if "regex_" in expected:
-            match = re.findall("(" + expected.strip('regex_') + ")", received)
-            if len(match) > 0:
-                command_is_valid = True
-        elif received == expected:
-            command_is_valid = True
-
-        if command_is_valid:
-            logging.info('Command Valid')
+    def _next_send_queue(self) -> Optional[Deque[CommandRequest]]:
+        """Highest priority queue with a command ready to be sent.
+
+        Background commands wait for the stylus to be idle.
+        """
+        for priority, send_queue in enumerate(self.send_queues):
+            if send_queue and (priority != PRIORITY_BACKGROUND or self._time_until_background() <= 0):
+                return send_queue
+        return None
+
+    def _time_until_background(self) -> float:
+        """Seconds until the background commands can be sent."""
+        deferral_end = self.send_queues[PRIORITY_BACKGROUND][0].queued_time + BACKGROUND_MAX_DEFERRAL
+        return min(self.controller.socket_listener.time_until_stylus_idle(), deferral_end - time.monotonic())
+
+    def _has_commands_to_send(self) -> bool:
+        return self._next_send_queue() is not None
+
+    def _can_send(self) -> bool:
+        """True if the client is connected, there are commands to send and room for them in the window."""
+        return self.controller.client.is_connected and self._has_commands_to_send() \
+            and len(self.in_flight) < self.window_size
+
+    def _time_until_next_event(self) -> Optional[float]:
+        """Seconds until a command can be sent or times out. None if there is nothing to send or wait for."""
+        if not self.controller.client.is_connected:  # The pending commands are cancelled right away.
+            return 0 if self.in_flight or any(self.send_queues) else None
+        times = [request.deadline for request in self.in_flight]
+        if self._can_send():
+            times.append(self._last_sent_time + self.controller.control_box_parameters.min_command_interval)
+        elif self.send_queues[PRIORITY_BACKGROUND] and not self._has_commands_to_send():  # Deferred.
+            times.append(time.monotonic() + self._time_until_background())
+        return min(times) - time.monotonic() if times else None
+
+    def update_board_state(self, received: str):
+        """Update the controller InternalBoardState from a board reply.
+
+        The reply is dispatched to its handler in `REPLY_HANDLERS` by opcode.
+        """
+        if (match := REPLY_OPCODE_PATTERN.match(received)) is None:
+            return
+        if (handler := REPLY_HANDLERS.get(match[1] or match[2])) is None:
+            return
+        pattern, update = handler
+        if (match := pattern.match(received)) is not None:
+            update(self, match)
+        else:
+            rate_limited_log.error('parse_reply', 'Could not parse reply: %r', received)
+
+    @reply_handler('a', r"%a#")
+    def _on_ping(self, match: re.Match):
+        if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+            wire_logger.info('Ping command was received.')
+
+    @reply_handler('pl', r"%pl,(\d)#")
+    def _on_board_interface(self, match: re.Match):
+        if match[1] == "0":
+            self.controller.internal_board_state.board_interface = "Dcs5LinkStream"
+            logging.info(f'Interface set to DcsLinkStream')
+        elif match[1] == "1":
+            self.controller.internal_board_state.board_interface = "FEED"
+            logging.info(f'Interface set to FEED')
+
+    @reply_handler('sn', r"%sn:(\d)#")
+    def _on_stylus_status_msg(self, match: re.Match):
+        if match[1] == "1":
+            self.controller.internal_board_state.stylus_status_msg = "enable"
+            logging.info('Stylus Status Message Enable')
         else:
-            logging.error(f'Unexpected: Command received: {[received]}, Command expected: {[expected]}')
+            self.controller.internal_board_state.stylus_status_msg = "disable"
+            logging.info('Stylus Status Message Disable')
+
+    @reply_handler('di', r"%di:(\d+)#")
+    def _on_stylus_settling_delay(self, match: re.Match):
+        self.controller.internal_board_state.stylus_settling_delay = int(match[1])
+        logging.info(f"Stylus settling delay set to {match[1]}")
+
+    @reply_handler('dm', r"%dm:(\d+)#")
+    def _on_stylus_max_deviation(self, match: re.Match):
+        self.controller.internal_board_state.stylus_max_deviation = int(match[1])
+        logging.info(f"Stylus max deviation set to {int(match[1])}")
+
+    @reply_handler('dn', r"%dn:(\d+)#")
+    def _on_number_of_reading(self, match: re.Match):
+        self.controller.internal_board_state.number_of_reading = int(match[1])
+        logging.info(f"Stylus number set to {int(match[1])}")
+
+    @reply_handler('b', r"%b:(.*)#")
+    def _on_board_stats(self, match: re.Match):
+        logging.info(f'Board State: {match[1]}')
+        self.controller.internal_board_state.board_stats = match[1]
+        firmware_version = match[1].split(',')[1]
+        self.controller.internal_board_state.firmware = firmware_version[:-2] + '.' + firmware_version[-2:]
+
+    @reply_handler('q', r"%q:(\d+),(\d+)#")
+    def _on_battery_level(self, match: re.Match):
+        logging.info(f'Battery level: {match[1]}')
+        self.controller.internal_board_state.battery_level = int(match[1])
+        if self.controller.devices_specifications.control_box.model == "xt":
+            self.controller.internal_board_state.is_charging = bool(int(match[2]))
+
+    @reply_handler('qe', r"%qe:(\d+)#")
+    def _on_battery_time_to_empty(self, match: re.Match):
+        logging.info(f'Battery time to empty: {match[1]}')
+        self.controller.internal_board_state.is_charging = int(match[1]) == 65535
+        self.controller.internal_board_state.battery_time_to_empty = int(match[1])
+
+    @reply_handler('t', r"%t,(\d+),(\d+)#")
+    def _on_temperature_humidity(self, match: re.Match):
+        logging.info(f'temperature: {match[1]}, humidity: {match[2]}')
+        self.controller.internal_board_state.temperature = int(match[1])
+        self.controller.internal_board_state.humidity = int(match[2])
+
+    @reply_handler('u', r"%u:([01])#")
+    def _on_calibration_state(self, match: re.Match):
+        self.controller.internal_board_state.calibrated = match[1] == '1'
+        logging.info('Board is calibrated.' if match[1] == '1' else 'Board is not calibrated.')
+
+    @reply_handler('la', r"%la,(\d+)#")
+    def _on_backlighting_level(self, match: re.Match):
+        self.controller.internal_board_state.backlighting_level = int(match[1])
+        logging.info(f'Backlight level set to {match[1]}')
+
+    @reply_handler('mm', r"%([12])mm,(\d+)#")
+    def _on_calibration_point(self, match: re.Match):
+        logging.info(f"Calibration point {match[1]} set to {match[2]} mm")
+        setattr(self.controller.internal_board_state, f'cal_pt_{match[1]}', int(match[2]))
+
+    @reply_handler('Cal Pt', r"Cal Pt ([12]) set to: (\d+)")  # used to work on firmwares v1.07 (I think) of XT.
+    def _on_calibration_point_v1(self, match: re.Match):
+        logging.info(f"Calibration point {match[1]} set to {match[2]} mm")
+        setattr(self.controller.internal_board_state, f'cal_pt_{match[1]}', int(match[2]))
+
+    @staticmethod
+    def is_expected(received: str, expected: str) -> bool:
+        """Expected messages starting with `regex_` are matched as regular expression."""
+        if "regex_" in expected:
+            return len(re.findall("(" + expected.strip('regex_') + ")", received)) > 0
+        return received == expected
+
+    def _time_until_next_write(self) -> float:
+        """Consecutive writes are at least `min_command_interval` seconds apart (control box parameters)."""
+        return self._last_sent_time + self.controller.control_box_parameters.min_command_interval - time.monotonic()
 
-    def _send_command(self):
-        command = self.send_queue.get()
-        self.controller.client.send(command)
-        logging.info(f'Command Sent: {[command]}')
+    def _send_commands(self):
+        """Send up to `max_commands_per_write` (control box parameters) queued commands in one write,
+        without exceeding the window.
+
+        Commands are taken by priority. Commands sent again after a timeout go first within their priority.
+        """
+        parameters = self.controller.control_box_parameters
+        requests = []
+        room = self.window_size - len(self.in_flight)
+        with self.condition:  # Queued settings are coalesced until they are taken from the send queue.
+            while len(requests) < min(parameters.max_commands_per_write, room) \
+                    and (send_queue := self._next_send_queue()) is not None:
+                requests.append(send_queue.popleft())
+                if self._unsent_settings.get(requests[-1].coalesce_key) is requests[-1]:
+                    del self._unsent_settings[requests[-1].coalesce_key]
+
+        self.controller.client.send("".join(request.command for request in requests))
+        self._last_sent_time = time.monotonic()
+        for request in requests:
+            request.attempts += 1
+            if request.expected:
+                request.deadline = self._last_sent_time + request.timeout
+                self.in_flight.append(request)
+            else:
+                request.finish()
+        self.metrics.sent += len(requests)
+        self.metrics.in_flight = len(self.in_flight)
+        if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+            wire_logger.info('Command Sent: %s', [request.command for request in requests])
 
 
 class SocketListener:
     """The socket listener also does the command interpretation."""
     def __init__(self, controller: Dcs5Controller):
         self.controller = controller
-        self.message_queue = Queue()
-        self.buffer = ""
         self.swipe_triggered = False
         self.with_mode = False
         self.last_key = None
         self.last_command = None
+        self.stylus_down = False
+        self.last_stylus_activity: float = None
+        self.last_user_activity: float = None  # Last measurement, swipe or key.
 
     def reset(self):
         self.swipe_triggered = False
         self.with_mode = False
         self.last_key = None
         self.last_command = None
+        self.stylus_down = False
+        self.last_stylus_activity = None
+        self.last_user_activity = time.monotonic()
 
         self.controller.client.clear()
-        self.clear_buffer()
-        self.message_queue.queue.clear()
-
-    def clear_buffer(self):
-        self.buffer = ""
 
     def listen(self):
         self.reset()
-        logging.info("Listener Queue and Client Buffers Cleared.")
+        logging.info("Listener and Client Buffers Cleared.")
         logging.debug('listener_handler_sync_barrier set.')
         self.controller.listener_handler_sync_barrier.wait()
 
         logging.info('Listening started')
+        link_monitor = self.controller.link_monitor
+        link_monitor.reset()
         while self.controller.is_listening:
-            self.buffer += self.controller.client.receive()
-            if len(self.buffer) > 0:
-                logging.info(f'Raw Buffer: {[self.buffer]}')
-                self._split_board_message()
-                self._process_board_message()
-            time.sleep(LISTENER_SLEEP)
+            timeout = link_monitor.time_until_check() if self.controller.client.is_connected else None
+            if self.controller.client.wait_for_data(timeout):
+                if frames := self.controller.client.receive_frames():
+                    link_monitor.on_frames(frames)
+                    self._process_board_messages(frames)
+            elif self.controller.client.is_connected:
+                link_monitor.check()
+            if not self.controller.client.is_connected:  # The command handler cancels the pending commands.
+                self.controller.command_handler.wakeup()
 
         logging.debug('listener_handler_sync_ stop barrier set.')
         self.controller.listening_stopped_barrier.wait()
         logging.info('Listening stopped')
 
-    def _split_board_message(self):
-        msg = self.buffer.split(BOARD_MESSAGE_DELIMITER, 1)
-        if len(msg) > 1:
-            self.message_queue.put(msg[0] + BOARD_MESSAGE_DELIMITER)
-            self.buffer = msg[1]
-
-    def _process_board_message(self):
-        """ANALYZE SOLICITED VS UNSOLICITED MESSAGE"""
-        while not self.message_queue.empty():
-            message = self.message_queue.get()
-            logging.info(f'Received Message: {message}')
-
-            if "@@@" in message:
-                logging.info('Usb Cabled plugged in.')
-                continue
-
-            output_value: str = None
-            msg_type, msg_value = self._decode_board_message(message)
-            logging.info(f"Message Type: {msg_type}, Message Value: {msg_value}")
+    def time_until_stylus_idle(self) -> float:
+        """Seconds until the stylus is idle: up and no measurement or swipe for `STYLUS_ACTIVE_PERIOD` seconds."""
+        if self.stylus_down:
+            return STYLUS_ACTIVE_PERIOD
+        if self.last_stylus_activity is None:
+            return 0
+        return max(self.last_stylus_activity + STYLUS_ACTIVE_PERIOD - time.monotonic(), 0)
 
-            if msg_type == "controller_box_key":
-                output_value = self._map_control_box_output(msg_value)
-                logging.info(f"Controller Box Output: {output_value}")
+    def _process_board_messages(self, frames: List[str]):
+        """ANALYZE SOLICITED VS UNSOLICITED MESSAGE
 
-            elif msg_type == 'swipe':
-                self.swipe_value = msg_value
-                if msg_value > self.controller.config.output_modes.swipe_threshold:
+        Parameters
+        ----------
+        frames :
+            Every frame received by a single read, in order.
+        """
+        for message in frames:
+            output: KeyEntry = None
+            board_message = decode_board_message(message)
+            if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                wire_logger.info('Received Message: %r -> %r', message, board_message)
+
+            if isinstance(board_message, ControlBoxKey):
+                self.last_user_activity = time.monotonic()
+                if (output := self._map_control_box_output(board_message.value)) is not None and wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                    wire_logger.info('Controller Box Output: %s', output.value)
+
+            elif isinstance(board_message, Swipe):
+                self.last_stylus_activity = self.last_user_activity = time.monotonic()
+                self.swipe_value = board_message.value
+                if board_message.value > self.controller.config.output_modes.swipe_threshold:
                     self.swipe_triggered = True
 
-            elif msg_type == 'length':
+            elif isinstance(board_message, LengthMeasurement):
+                self.last_stylus_activity = self.last_user_activity = time.monotonic()
                 if self.swipe_triggered is True:
-                    self._check_for_stylus_swipe(msg_value)
+                    self._check_for_stylus_swipe(board_message.value)
                 else:
-                    output_value = self._map_board_length_measurement(msg_value)
+                    output = self._map_board_length_measurement(board_message.value)
+
+            elif isinstance(board_message, Reply):
+                self.controller.command_handler.put_received(board_message.value)
+
+            elif isinstance(board_message, StylusStatus):
+                self.stylus_down = board_message.value == 1
+                self.last_stylus_activity = time.monotonic()
+                if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                    wire_logger.info('Stylus %s.', 'down' if board_message.value else 'up')
 
-            elif msg_type == "solicited":
-                self.controller.command_handler.received_queue.put(msg_value)
+            elif isinstance(board_message, UsbPlugged):
+                logging.info('Usb Cabled plugged in.')
 
-            if output_value is not None:
-                self.last_command = output_value
-                self._process_output(output_value)
+            if output is not None:
+                self.last_command = output.value
+                self._process_output(output.actions)
 
-                if msg_type == 'length' \
+                if isinstance(board_message, LengthMeasurement) \
                         and self.controller.output_mode == 'length' \
                         and self.controller.auto_enter is True:
                     self.controller.to_keyboard('enter')
 
-    @staticmethod
-    def _decode_board_message(value: str) -> Tuple[str,str]:
-        """
-        """
-        patterns = [
-            "%t,([0-9])#",  # stylus up/down
-            "%l,([0-9]*)#",  # length measurement
-            "%s,(-?\d+)#",  # swipe
-            "%hs,([0-9])#",  # Micro button
-            "%k,([0-9]{2})#",  # Xt button v2.0.0+
-
-        ]
-        match = re.findall("|".join(patterns), value)
-        if len(match) > 0:
-            if match[0][1] != "":
-                return 'length', int(match[0][1])
-            elif match[0][2] != "":
-                return 'swipe', int(match[0][2])
-            elif match[0][3] != "":
-                return 'controller_box_key', match[0][3]
-            elif match[0][4] != "":
-                return 'controller_box_key', match[0][4]
-        else:
-            return 'solicited', value
-
-    def _process_output(self, value: Tuple[List[str], str]):
-        if isinstance(value, list):
-            for _value in value:
-                self._process_output(_value)
-        elif isinstance(value, str):
-            if value == "MODE":
+    def _process_output(self, actions: Tuple[KeyAction, ...]):
+        for action in actions:
+            if action.command == "MODE":
                 self.set_with_mode(not self.with_mode)
             else:
                 self.set_with_mode(False)
-                if value in self.controller.controller_commands:
-                    self.controller.mapped_controller_commands(value)
+                if action.command is not None:
+                    self.controller.controller_commands[action.command]()
                 else:
-                    if value.startswith(PRINT_COMMAND):
-                        value = value[len(PRINT_COMMAND):]
-                    self.controller.to_keyboard(value)
-        else:
-            raise ValueError(f'CRITICAL error in _process_output.')
+                    self.controller.to_keyboard(action.keyboard)
 
     def set_with_mode(self, value: bool):
         if value is not self.with_mode:
@@ -1033,43 +1742,29 @@ class SocketListener:
         else:
             pass
 
-    def _map_control_box_output(self, value) -> str:
-        key = self.controller.devices_specifications.control_box.keys_layout[value]
-        self.last_key = key
-        if self.with_mode:
-            return self.controller.config.key_maps.control_box_mode[key]
-        else:
-            return self.controller.config.key_maps.control_box[key]
-
-    def _map_board_length_measurement(self, value: int) -> str:
-        if self.controller.output_mode == 'length':
-            out_value = value - self.controller.stylus_offset
-            self.last_key = out_value
-            if self.controller.length_units == 'cm':
-                out_value /= 10
-            return str(out_value)
-
-        else:
-            index = int(
-                (value - self.controller.devices_specifications.board.relative_zero)
-                / self.controller.devices_specifications.board.key_to_mm_ratio
-            )
-            if index < self.controller.devices_specifications.board.number_of_keys:
-                key = self.controller.devices_specifications.board.keys_layout[self.controller.output_mode][index]
-                self.last_key = key
-                if self.with_mode:
-                    return self.controller.config.key_maps.board_mode[key]
-                else:
-                    return self.controller.config.key_maps.board[key]
+    def _map_control_box_output(self, value: str) -> Optional[KeyEntry]:
+        if (entry := self.controller.key_tables.control_box_entry(self.with_mode, value)) is None:
+            rate_limited_log.error('unknown_key', 'Unknown control box key: %s', value)
+            return None
+        self.last_key = entry.key
+        return entry if entry.value is not None else None
+
+    def _map_board_length_measurement(self, value: int) -> Optional[KeyEntry]:
+        entry = self.controller.key_tables.measurement_entry(
+            self.controller.output_mode, self.with_mode, value, self.controller.stylus_offset,
+            self.controller.length_units
+        )
+        if entry is None:
+            return None
+        self.last_key = entry.key
+        return entry if entry.value is not None else None
 
     def _check_for_stylus_swipe(self, value: str):
         self.swipe_triggered = False
         self.last_input = "swipe"
-        segments_limits = self.controller.config.output_modes.segments_limits
-        if value <= segments_limits[-1]:
-            for l_max, l_min, mode in zip(segments_limits[1:],
-                                          segments_limits[:-1],
-                                          self.controller.config.output_modes.segments_mode):
-                if l_max >= int(value) > l_min:
-                    self.controller.change_board_output_mode(mode)
-                    break
+        if (mode := self._find_swipe_segment_mode(value)) is not None:
+            self.controller.change_board_output_mode(mode)
+
+    def _find_swipe_segment_mode(self, value: int) -> Optional[str]:
+        """Return the output mode of the segment the swipe ended in."""
+        return self.controller.config.output_modes.find_segment_mode(value)
@@ -38,16 +38,20 @@ Valid keyboard inputs :
     'up', 'volumedown', 'volumemute', 'volumeup', 'win', 'winleft', 'winright', 'yen',
     'command', 'option', 'optionleft', 'optionright']
 """
+import os
+from bisect import bisect_left
 from json.decoder import JSONDecodeError
 from dataclasses import dataclass
+from types import MappingProxyType
 from typing import *
 
 from dcs5 import PRINT_COMMAND
+from dcs5.devices_specifications import DevicesSpecifications
 from dcs5.utils import json2dict
 
 VALID_COMMANDS = ["BACKLIGHT_UP", "BACKLIGHT_DOWN", "CHANGE_STYLUS", "UNITS_mm", "UNITS_cm", "MODE",
                   "CHANGE_OUTPUT_MODE", "MODE_TOP", "MODE_LENGTH", "MODE_BOTTOM", "WEIGHT", "DELETE_LAST"]
-VALID_SEGMENTS_MODE = ['length', 'top', 'bottom']
+VALID_SEGMENTS_MODE = ['length', 'top', 'bottom', 'ignore']  # Swipes ending in an `ignore` segment do nothing.
 VALID_KEYBOARD_KEYS = [
     '\t', '\n', '\r', ' ', '!', '"', '#', '$', '%', '&', "'",
     '(', ')', '*', '+', ',', '-', '.', '/', '{', '|', '}', '~',
@@ -77,6 +81,7 @@ VALID_KEYBOARD_KEYS = [
     'command', 'option', 'optionleft', 'optionright'
 ]
 VALID_UNITS = ["mm", "cm"]
+VALID_TRANSPORTS = ['bluetooth', 'tcp', 'serial', 'in_process']
 
 
 def check_key_map(key_map: Dict[str, str]):
@@ -107,6 +112,16 @@ class Client:
     device_name: str
     mac_address: str
     marel_ip_address: str
+    transport: str = 'bluetooth'
+    address: str = None  # tcp: `host:port`, serial: `path[:baudrate]`, in_process: simulated model.
+
+    def __post_init__(self):
+        if self.transport not in VALID_TRANSPORTS:
+            raise ConfigError(f'Invalid value for `client/transport`. Must be one of {VALID_TRANSPORTS}')
+        if self.transport in ['tcp', 'serial'] and not self.address:
+            raise ConfigError(f'A `client/address` is required for the `{self.transport}` transport.')
+        if self.transport == 'serial' and os.name != 'posix':
+            raise ConfigError('The `serial` transport is only supported on POSIX systems (Linux, macOS).')
 
 
 @dataclass
@@ -160,9 +175,104 @@ class OutputModes:
         self.mode_reading_profiles = ModeReadingProfiles(**self.mode_reading_profiles)
         if len(self.segments_limits) - 1 != len(self.segments_mode):
             raise ConfigError('Invalid value for `output_modes/segments_limits`. It needs to have one more element than `segments_mode`.')
+        if any(l_min >= l_max for l_min, l_max in zip(self.segments_limits[:-1], self.segments_limits[1:])):
+            raise ConfigError('Invalid value for `output_modes/segments_limits`. Limits must be strictly increasing (segments cannot overlap).')
         if any(m not in VALID_SEGMENTS_MODE for m in self.segments_mode):
             raise ConfigError(f'Invalid value for `outputs_modes/segments_mode`. Must be in {VALID_SEGMENTS_MODE}')
 
+        self._segments_limits = tuple(self.segments_limits)
+        self._segments_mode = tuple(None if m == 'ignore' else m for m in self.segments_mode)
+
+    def find_segment_mode(self, value: int) -> Optional[str]:
+        """Return the output mode of the segment `(limit[i], limit[i+1]]` containing `value` (mm).
+
+        None if `value` is outside the segments or in an `ignore` segment.
+        """
+        index = bisect_left(self._segments_limits, value)
+        if 0 < index < len(self._segments_limits):
+            return self._segments_mode[index - 1]
+        return None
+
+
+class KeyAction(NamedTuple):
+    """A compiled key map value. `command` (VALID_COMMANDS) or `keyboard` (key or text to print) is set."""
+    command: Optional[str]
+    keyboard: Optional[str]
+
+
+class KeyEntry(NamedTuple):
+    """
+    key :
+        Key name from the devices specifications keys layout.
+    value :
+        Key map value.
+    actions :
+        Compiled key map value.
+    """
+    key: Union[str, int]
+    value: Union[str, List[str]]
+    actions: Tuple[KeyAction, ...]
+
+
+@dataclass(frozen=True)
+class KeyTables:
+    """Key maps compiled against the keys layouts of the devices specifications.
+
+    `with_mode` is the MODE state (False: `control_box`/`board` key maps, True: `*_mode` key maps).
+
+    control_box :
+        [with_mode][control box code] -> KeyEntry
+    board :
+        [output_mode][with_mode][position (mm)] -> KeyEntry or None (between or outside the keys).
+        For the `top` and `bottom` output modes. Positions go from 0 to `Board.max_position`.
+    command_keys :
+        command -> control box key number. (reverse mapping)
+    """
+    control_box: Tuple[Mapping[str, KeyEntry], Mapping[str, KeyEntry]]
+    board: Mapping[str, Tuple[Tuple[Optional[KeyEntry], ...], Tuple[Optional[KeyEntry], ...]]]
+    command_keys: Mapping[str, int]
+
+    def board_entry(self, output_mode: str, with_mode: bool, position: int) -> Optional[KeyEntry]:
+        """Return the entry of the board key at `position` (mm). None if out of range."""
+        table = self.board[output_mode][with_mode]
+        return table[position] if 0 <= position < len(table) else None
+
+    def control_box_entry(self, with_mode: bool, code: str) -> Optional[KeyEntry]:
+        """Return the entry of the control box key `code`. None if unknown."""
+        return self.control_box[with_mode].get(code)
+
+    def measurement_entry(self, output_mode: str, with_mode: bool, position: int, stylus_offset: int,
+                          length_units: str) -> Optional[KeyEntry]:
+        """Map a board measurement (mm) to its entry.
+
+        In the `length` output mode, the entry prints the length (`position - stylus_offset`) in `length_units`
+        (mm or cm) and its key is the length in mm. Else, it is the entry of the board key at `position`.
+        """
+        if output_mode == 'length':
+            length = position - stylus_offset
+            value = str(length / 10 if length_units == 'cm' else length)
+            return KeyEntry(length, value, (KeyAction(None, value),))
+        return self.board_entry(output_mode, with_mode, position)
+
+    def classify_board_positions(self, output_mode: str, positions: Iterable[int], with_mode: bool = False
+                                 ) -> List[Optional[KeyEntry]]:
+        """Map recorded positions (mm) to their board key entry. e.g. to replay a recording."""
+        table = self.board[output_mode][with_mode]
+        size = len(table)
+        return [table[position] if 0 <= position < size else None for position in positions]
+
+
+def compile_key_actions(value: Union[str, List[str]]) -> Tuple[KeyAction, ...]:
+    if value is None:
+        return ()
+    if isinstance(value, list):
+        return tuple(action for _value in value for action in compile_key_actions(_value))
+    if value in VALID_COMMANDS:
+        return (KeyAction(value, None),)
+    if value.startswith(PRINT_COMMAND):
+        return (KeyAction(None, value[len(PRINT_COMMAND):]),)
+    return (KeyAction(None, value),)
+
 
 @dataclass
 class KeyMaps:
@@ -177,6 +287,39 @@ class KeyMaps:
         check_key_map(self.control_box_mode)
         check_key_map(self.board_mode)
 
+    def compile(self, devices_specifications: DevicesSpecifications) -> KeyTables:
+        """Compile the key maps into the KeyTables used to map the board and control box inputs."""
+        def entry(key: str, key_map: Dict[str, str]) -> KeyEntry:
+            return KeyEntry(key, key_map.get(key), compile_key_actions(key_map.get(key)))
+
+        control_box_layout = devices_specifications.control_box.keys_layout
+        control_box = tuple(
+            MappingProxyType({code: entry(key, key_map) for code, key in control_box_layout.items()})
+            for key_map in (self.control_box, self.control_box_mode)
+        )
+
+        board_specifications = devices_specifications.board
+        key_indexes = [board_specifications.key_index(position) for position in range(board_specifications.max_position + 1)]
+        board = {}
+        for output_mode, keys in board_specifications.keys_layout.items():
+            board[output_mode] = tuple(
+                tuple(entries[index] if index is not None and index < len(entries) else None for index in key_indexes)
+                for entries in ([entry(key, key_map) for key in keys] for key_map in (self.board, self.board_mode))
+            )
+        board = MappingProxyType(board)
+
+        key_codes = {key: code for code, key in control_box_layout.items()}
+        command_keys = {}
+        for key in self.control_box:
+            if key not in key_codes:
+                continue
+            for value in (self.control_box[key], self.control_box_mode.get(key)):
+                for action in compile_key_actions(value):
+                    if action.command is not None:
+                        command_keys.setdefault(action.command, int(key_codes[key]))
+
+        return KeyTables(control_box=control_box, board=board, command_keys=MappingProxyType(command_keys))
+
 
 @dataclass
 class ControllerConfiguration:
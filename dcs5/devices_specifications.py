@@ -1,5 +1,6 @@
+import math
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from dcs5.utils import json2dict
 
@@ -22,6 +23,14 @@ class Board:
 
     def __post_init__(self):
         self.relative_zero = self.zero - self.detection_range
+        self.max_position = int(self.relative_zero + self.number_of_keys * self.key_to_mm_ratio)  # mm
+
+    def key_index(self, position: int) -> Optional[int]:
+        """Return the index of the key at `position` (mm). None if `position` is not on a key."""
+        if not 0 <= position <= self.max_position:
+            return None
+        index = math.floor((position - self.relative_zero) / self.key_to_mm_ratio)
+        return index if 0 <= index < self.number_of_keys else None
 
 
 @dataclass
@@ -18,7 +18,7 @@ import pyautogui as pag
 from dcs5 import VERSION, LOCAL_FILE_PATH, CONFIG_FILES_PATH
 from dcs5.controller import Dcs5Controller
 from dcs5.controller_configurations import ConfigError
-from dcs5.logger import init_logging
+from dcs5.logger import init_logging, set_wire_logging, is_wire_logging, get_multiline_handler, remove_log_handler
 from dcs5.utils import resolve_relative_path, update_json_value, json2dict
 
 # This is a fix for my computer. Should not influence anything.
@@ -343,6 +343,10 @@ def make_window():
         col([marel_layout])
     ]
 
+    log_tab_layout = [
+        [sg.Multiline(size=(80, 20), font=SMALL_FONT, key='-LOG-', autoscroll=True, disabled=True, expand_x=True)]
+    ]
+
     controller_tab_layout = [
         col([device_layout]),
         col([status_layout]),
@@ -356,15 +360,7 @@ def make_window():
 
     # MENU #
 
-    _menu_layout = [
-        ['&Dcs5', [
-            '&Configuration',
-            '---',
-            '&Exit']],
-        ['Help', ['Guide_fr', 'Guide_en']]
-    ]
-
-    menu_layout = [sg.Menu(_menu_layout, k='-MENU-', p=0, font=REG_FONT, disabled_text_color='grey'), ]
+    menu_layout = [sg.Menu(make_menu_definition(), k='-MENU-', p=0, font=REG_FONT, disabled_text_color='grey'), ]
 
     # FOOTNOTE #
     footnote_layout = [[
@@ -377,7 +373,8 @@ def make_window():
         [menu_layout],
         [sg.TabGroup([
             [sg.Tab('Dcs5', controller_tab_layout, element_justification='center')],
-            [sg.Tab('Marel', marel_tab_layout, element_justification='center')]
+            [sg.Tab('Marel', marel_tab_layout, element_justification='center')],
+            [sg.Tab('Log', log_tab_layout, element_justification='center')]
         ])],
         [footnote_layout]
     ]
@@ -401,6 +398,17 @@ def make_window():
     return window
 
 
+def make_menu_definition():
+    return [
+        ['&Dcs5', [
+            '&Configuration',
+            'Disable Wire Logging' if is_wire_logging() else 'Enable Wire Logging',
+            '---',
+            '&Exit']],
+        ['Help', ['Guide_fr', 'Guide_en']]
+    ]
+
+
 def run():
     sg.user_settings_filename(USER_SETTING_FILE, LOCAL_FILE_PATH)
     load_user_settings()
@@ -421,6 +429,9 @@ def run():
     window.metadata = {
         'is_connecting': False,
         'previous_configs_path': None,
+        'log_handler': get_multiline_handler(
+            window, '-LOG-', level='DEBUG' if APP_SETTINGS['debug'] is True else 'INFO'
+        ),
     }
 
     if sg.user_settings()['configs_path'] is not None:
@@ -433,6 +444,8 @@ def run():
 
     loop_run(window, controller)
 
+    remove_log_handler(window.metadata['log_handler'])
+
     save_user_settings()
 
 
@@ -450,6 +463,8 @@ def loop_run(window: sg.Window, controller: Dcs5Controller):
     while True:
         event, values = window.read(timeout=.05)
 
+        window.metadata['log_handler'].update_window()
+
         if event != "__TIMEOUT__" and event is not None:
             logging.debug(f'{event}, {values}')
 
@@ -542,6 +557,9 @@ def loop_run(window: sg.Window, controller: Dcs5Controller):
                 else:
                     controller.mute_board()
                     window['-MUTE-'].update(text='Unmute')
+            case 'Enable Wire Logging' | 'Disable Wire Logging':
+                set_wire_logging(not is_wire_logging())
+                window['-MENU-'].update(menu_definition=make_menu_definition())
             case 'Guide_en':
                 webbrowser.open_new(USER_GUIDE_FILE_ENGLISH)
             case 'Guide_fr':
@@ -1245,7 +1263,7 @@ def reload_controller_config(controller: Dcs5Controller):
             do_sync = sg.popup_yes_no('Do you want to synchronize board ?', keep_on_top=True, modal=True)
             logging.debug(f'Asking if the user wants to synchronize. Answer: {do_sync}')
             if do_sync == "Yes":
-                controller.init_controller_and_board()
+                controller.sync_board()
 
         sg.user_settings()['configs_path'] = sg.user_settings()['configs_path'].strip('*')
 
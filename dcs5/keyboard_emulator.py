@@ -1,7 +1,7 @@
-import logging
-
 import pyautogui as pag
 
+from dcs5.logger import wire_logger, WIRE_LOGGING_LEVEL
+
 pag.PAUSE = 0.01
 
 class KeyboardEmulator:
@@ -27,7 +27,8 @@ class KeyboardEmulator:
 
     def _shout(self, value: str):
         with pag.hold(self.meta_key_combo):
-            logging.info(f"Keyboard out: {'+'.join(self.meta_key_combo)} {value}")
+            if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                wire_logger.info('Keyboard out: %s %s', '+'.join(self.meta_key_combo), value)
             if pag.isValidKey(value):
                 pag.press(value)
                 self.last_msg_length = 1
@@ -2,16 +2,32 @@
 May 2022 JeromeJGuay
 This modules contains script to init the logger.
 """
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
 import sys
 import time
 import re
+from collections import deque
 from pathlib import Path
+from typing import *
 
 from dcs5 import LOG_FILES_PATH, MAX_COUNT_LOG_FILES
 
 LOG_FILE_PREFIX = "dcs5_log"
+LOG_QUEUE_SIZE = 10000  # Records are dropped when the queue is full.
+
+WIRE_LOGGER_NAME = "dcs5.wire"
+WIRE_LOGGING_LEVEL = logging.INFO
+
+wire_logger = logging.getLogger(WIRE_LOGGER_NAME)
+"""Wire-level traces (frames received, commands sent, keystrokes). Disabled by default, see `set_wire_logging`.
+
+Messages use %-style arguments and are guarded with `wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL)` so
+nothing is formatted while disabled.
+"""
+wire_logger.setLevel(logging.WARNING)
 
 RED_TEXT = "\x1b[31;20m"
 YELLOW_TEXT = "\x1b[33;20m"
@@ -34,35 +50,154 @@ class BasicLoggerFormatter(logging.Formatter):
         return f"{color}{fmt_time} - {fmt_thread} - {fmt_level} - {fmt_message}{RESET_TEXT}"
 
 
-class MultilineStdHandler:
+def set_wire_logging(value: bool):
+    """Enable or disable the wire-level traces. Can be called at runtime."""
+    wire_logger.setLevel(WIRE_LOGGING_LEVEL if value else logging.WARNING)
+    logging.info(f'Wire logging {"enabled" if value else "disabled"}.')
+
+
+def is_wire_logging() -> bool:
+    return wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL)
+
+
+class RateLimitedLogger:
+    """Log a repetitive message at most once per `interval` seconds per `key`.
+
+    The number of suppressed messages is appended to the next message logged for that key.
+    """
+    def __init__(self, logger: logging.Logger = None, interval: float = 5):
+        self.logger = logger or logging.getLogger()
+        self.interval = interval
+        self._last_logged: Dict[str, Tuple[float, int]] = {}  # key -> (time, suppressed count)
+
+    def log(self, level: int, key: str, msg: str, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        last_time, suppressed = self._last_logged.get(key, (-self.interval, 0))
+        if now - last_time < self.interval:
+            self._last_logged[key] = (last_time, suppressed + 1)
+            return
+        self._last_logged[key] = (now, 0)
+        if suppressed:
+            msg += ' (%d similar messages suppressed)'
+            args += (suppressed,)
+        self.logger.log(level, msg, *args)
+
+    def error(self, key: str, msg: str, *args):
+        self.log(logging.ERROR, key, msg, *args)
+
+    def warning(self, key: str, msg: str, *args):
+        self.log(logging.WARNING, key, msg, *args)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler that drops the records when the queue is full.
+
+    `dropped` counts the dropped records. A warning with the count is queued once there is room again.
+    """
+    def __init__(self, _queue: queue.Queue):
+        super().__init__(_queue)
+        self.dropped = 0
+        self._reported_dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped > self._reported_dropped:
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'dcs5.logger', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f'{self.dropped - self._reported_dropped} log records dropped (log queue full).',
+                }))
+                self._reported_dropped = self.dropped
+            except queue.Full:
+                pass
+
+
+class MultilineHandler(logging.Handler):
     """
     Handler for PySimpleGui Multiline.
+
+    Records are only buffered by `emit`. `update_window` must be called from the GUI thread
+    (e.g. in the event loop) to write the buffered records to the element in a batch.
     """
-    def __init__(self, window, key):
+    def __init__(self, window, key, max_lines: int = 1000):
+        super().__init__()
         self.window = window
         self.key = key
+        self.buffer = deque(maxlen=max_lines)
         self.ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 
-    def write(self, s):
+    def emit(self, record: logging.LogRecord):
+        try:
+            s = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
         c = 'red' if RED_TEXT in s else 'yellow' if YELLOW_TEXT in s else None
-        _s = self.ansi_escape.sub('', s)
+        self.buffer.append((self.ansi_escape.sub('', s) + '\n', c))
+
+    def update_window(self):
+        """Write the buffered records. Consecutive records of the same color are written at once."""
+        lines, color = [], None
+        while self.buffer:
+            _line, _color = self.buffer.popleft()
+            if lines and _color != color:
+                self._write(''.join(lines), color)
+                lines = []
+            lines.append(_line)
+            color = _color
+        if lines:
+            self._write(''.join(lines), color)
+
+    def _write(self, s: str, color: str):
         try:
-            self.window[self.key].update(value=_s, append=True, text_color_for_value = c)
+            self.window[self.key].update(value=s, append=True, text_color_for_value=color)
         except RuntimeError:
             pass
 
-    def flush(self):
-        return
 
-
-def get_multiline_handler(window, key, level='DEBUG"'):
-    window_handler = logging.StreamHandler(MultilineStdHandler(window=window, key=key))
+def get_multiline_handler(window, key, level='DEBUG'):
+    """Return a MultilineHandler fed by the logging thread. Call its `update_window` from the GUI thread."""
+    window_handler = MultilineHandler(window=window, key=key)
     window_handler.setLevel(level.upper())
     window_handler.setFormatter(BasicLoggerFormatter())
+    add_log_handler(window_handler)
 
     return window_handler
 
 
+_queue_listener: QueueListener = None
+
+
+def add_log_handler(handler: logging.Handler):
+    """Add a handler to the logging thread. (see `init_logging`)"""
+    if _queue_listener is None:
+        logging.getLogger().addHandler(handler)
+    else:
+        _queue_listener.handlers = _queue_listener.handlers + (handler,)
+
+
+def remove_log_handler(handler: logging.Handler):
+    """Remove a handler added with `add_log_handler`."""
+    if _queue_listener is None:
+        logging.getLogger().removeHandler(handler)
+    else:
+        _queue_listener.handlers = tuple(h for h in _queue_listener.handlers if h is not handler)
+
+
+def stop_logging():
+    """Stop the logging thread once the queued records are handled."""
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
 def clean_old_log_files(max_count):
     for files in sorted([x for x in Path(LOG_FILES_PATH).glob('*.log') if x.is_file()])[:-max_count]:
         files.unlink()
@@ -74,6 +209,8 @@ def init_logging(
         write=False,
 ):
     """
+    The records are put in a bounded queue (see LOG_QUEUE_SIZE) and handled (stdout and file)
+    by a single logging thread, so the threads logging never wait on I/O.
 
     Parameters
     ----------
@@ -88,6 +225,7 @@ def init_logging(
     -------
 
     """
+    global _queue_listener
     clean_old_log_files(max_count=MAX_COUNT_LOG_FILES)
 
     formatter = BasicLoggerFormatter()
@@ -109,7 +247,14 @@ def init_logging(
     file_handler.setFormatter(formatter)
     handlers.append(file_handler)
 
-    logging.basicConfig(level="NOTSET", handlers=handlers)
+    stop_logging()
+    _queue_listener = QueueListener(queue.Queue(maxsize=LOG_QUEUE_SIZE), *handlers, respect_handler_level=True)
+    _queue_listener.start()
+    atexit.register(stop_logging)
+
+    queue_handler = BoundedQueueHandler(_queue_listener.queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))  # The listener handlers do the formatting.
+    logging.basicConfig(level="NOTSET", handlers=[queue_handler], force=True)
 
     logging.debug('Logging Started.')
 
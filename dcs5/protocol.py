@@ -0,0 +1,222 @@
+"""
+This module contains the decoder of the messages (frames) sent by the board and the commands sent to the board.
+
+`decode_board_message` dispatches on the frame prefix and returns one of the BoardMessage below.
+Unsolicited messages (measurements, swipes, keys and stylus status) have their own type and every
+other frame is a Reply to a command.
+
+The command functions (e.g. `set_backlighting_level`) return the BoardCommand to send and the replies expected.
+They are shared by the Dcs5Controller and the AsyncDcs5Controller. The values ranges are not checked.
+
+Run `python -m dcs5.protocol` for a benchmark of the decoder.
+"""
+import re
+import timeit
+from typing import *
+
+
+class BoardMessage:
+    __slots__ = ('value',)
+    type: str = None
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.value!r})"
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.value == self.value
+
+
+class LengthMeasurement(BoardMessage):
+    """`%l,<mm>#`"""
+    __slots__ = ()
+    type = 'length'
+
+
+class Swipe(BoardMessage):
+    """`%s,<length>#`"""
+    __slots__ = ()
+    type = 'swipe'
+
+
+class ControlBoxKey(BoardMessage):
+    """`%k,<xx>#` (XT firmware 2.0.0+) or `%hs,<x>#` (Micro)"""
+    __slots__ = ()
+    type = 'controller_box_key'
+
+
+class StylusStatus(BoardMessage):
+    """`%t,<0|1>#`: stylus up (0) or down (1)."""
+    __slots__ = ()
+    type = 'stylus_status'
+
+
+class UsbPlugged(BoardMessage):
+    """`@@@`"""
+    __slots__ = ()
+    type = 'usb_plugged'
+
+
+class Reply(BoardMessage):
+    """Solicited message. The value is the frame."""
+    __slots__ = ()
+    type = 'solicited'
+
+
+# prefix -> (pattern, message class, value parser)
+_UNSOLICITED_MESSAGES = {
+    "%l,": (re.compile(r"%l,(\d+)#"), LengthMeasurement, int),
+    "%s,": (re.compile(r"%s,(-?\d+)#"), Swipe, int),
+    "%k,": (re.compile(r"%k,(\d{2})#"), ControlBoxKey, str),
+    "%hs": (re.compile(r"%hs,(\d)#"), ControlBoxKey, str),
+    "%t,": (re.compile(r"%t,(\d)#"), StylusStatus, int),  # Also the prefix of the temperature reply `%t,T,H#`.
+}
+
+
+def decode_board_message(frame: str) -> BoardMessage:
+    """Decode a `\\r` terminated frame."""
+    if (unsolicited := _UNSOLICITED_MESSAGES.get(frame[:3])) is not None:
+        pattern, message_class, parser = unsolicited
+        if (match := pattern.match(frame)) is not None:
+            return message_class(parser(match[1]))
+    elif "@@@" in frame:
+        return UsbPlugged(frame)
+    return Reply(frame)
+
+
+class BoardCommand(NamedTuple):
+    """
+    command :
+        Command sent to the board.
+    expected :
+        Reply or replies expected, in order. Replies starting with `regex_` are regular expressions.
+        None if the board does not reply.
+    """
+    command: str
+    expected: Union[str, List[str], None]
+
+
+OUTPUT_MODE_FUEL_GAUGE_PATTERNS = {
+    'xt': {'bottom': int("00001111", 2), 'top': int("11110000", 2), 'length': int("00111100", 2)},
+    'micro': {'bottom': int("11000000", 2), 'top': int("00001100", 2), 'length': int("00000011", 2)},
+}
+MICRO_FUEL_GAUGE_COLOR = [int('FF', 16), int('60', 16), int('00', 16), int('00', 16)]  # orange
+
+
+def ping() -> BoardCommand:
+    return BoardCommand("&a#", "%a#\r")
+
+
+def get_board_stats() -> BoardCommand:
+    return BoardCommand("b#", "regex_%b.*#\r")
+
+
+def get_battery_level() -> BoardCommand:
+    return BoardCommand('&q#', "regex_%q:\d+,\d+#\r")
+
+
+def get_battery_time_to_empty() -> BoardCommand:
+    """Micro Only"""
+    return BoardCommand('&qe#', "regex_%qe:\d+#\r")
+
+
+def get_temperature_humidity() -> BoardCommand:
+    return BoardCommand('&t#', "regex_%t,\d+,\d+#\r")
+
+
+def board_initialization() -> BoardCommand:
+    return BoardCommand("&init#", ["Setting EEPROM init flag.\r", "Rebooting in 2 seconds.\r"])
+
+
+def set_interface(value: int) -> BoardCommand:
+    """0: DCSLinkstream, 1: FEED"""
+    host_app = {0: 'DCSLinkstream', 1: "FEED"}[value]
+    return BoardCommand(f"&pl,{value}#", [f'HostApp={host_app}\r', f"%pl,{value}#\r"])
+
+
+def flash_fuel_gauge() -> BoardCommand:
+    return BoardCommand("&ra#", "%ra#\r")
+
+
+def _fuel_gauge_args(*args: int, color: list = None) -> str:
+    return ','.join(map(str, list(args) + (color or [])))
+
+
+def set_fuel_gauge(value: int, color: list = None) -> BoardCommand:
+    """`color` (r, g, b, w) is for the Micro only."""
+    args = _fuel_gauge_args(value, color=color)
+    return BoardCommand(f"&lf,{args}#", f"%lf,{args}#\r")
+
+
+def set_fuel_gauge_temporary(delay: int, value: int, color: list = None) -> BoardCommand:
+    """`color` (r, g, b, w) is for the Micro only."""
+    args = _fuel_gauge_args(delay, value, color=color)
+    return BoardCommand(f"&lt,{args}#", f"%lt,{args}#\r")
+
+
+def set_output_mode_fuel_gauge(model: str, output_mode: str) -> BoardCommand:
+    """Fuel gauge (XT) or led rings (Micro) pattern showing the `output_mode`."""
+    value = OUTPUT_MODE_FUEL_GAUGE_PATTERNS[model][output_mode]
+    return set_fuel_gauge(value) if model == 'xt' else set_fuel_gauge(value, MICRO_FUEL_GAUGE_COLOR)
+
+
+def set_backlighting_level(level: int) -> BoardCommand:
+    return BoardCommand(f'&la,{level}#', f"%la,{level}#\r")
+
+
+def set_key_backlighting_level(level: int, key: int) -> BoardCommand:
+    """Keys are numbered from 0."""
+    return BoardCommand(f'&lk,{level},{key}#', f"%lk,{level},{key}#\r")
+
+
+def set_stylus_detection_message(value: bool) -> BoardCommand:
+    """When disabled (false): %t0 %t1 are not sent"""
+    return BoardCommand(f'&sn,{int(value)}#', f'%sn:{int(value)}#\r')
+
+
+def set_stylus_settling_delay(value: int) -> BoardCommand:
+    return BoardCommand(f"&di,{value}#", f"%di:{value}#\r")
+
+
+def set_stylus_max_deviation(value: int) -> BoardCommand:
+    return BoardCommand(f"&dm,{value}#", f"%dm:{value}#\r")
+
+
+def set_stylus_number_of_reading(value: int) -> BoardCommand:
+    return BoardCommand(f"&dn,{value}#", f"%dn:{value}#\r")
+
+
+def restore_cal_data() -> BoardCommand:
+    return BoardCommand("&cr,m1,m2,raw1,raw2#", None)
+
+
+def clear_cal_data() -> BoardCommand:
+    return BoardCommand("&ca#", None)
+
+
+def check_calibration_state() -> BoardCommand:
+    return BoardCommand('&u#', 'regex_%u:\d#\r')
+
+
+def set_calibration_points_mm(pt: int, pos: int) -> BoardCommand:
+    return BoardCommand(f'&{pt}mm,{pos}#', f'%{pt}mm,{pos}#\r')
+
+
+BENCHMARK_FRAMES = [
+    "%l,254#\r", "%s,12#\r", "%k,07#\r", "%hs,2#\r", "%t,1#\r", "%t,22,40#\r", "%la,95#\r", "%di:9#\r",
+]
+
+
+def benchmark(number: int = 100_000) -> Dict[str, float]:
+    """Return the number of frames decoded per second, per frame."""
+    return {
+        frame: number / timeit.timeit(lambda: decode_board_message(frame), number=number)
+        for frame in BENCHMARK_FRAMES
+    }
+
+
+if __name__ == "__main__":
+    for _frame, frames_per_second in benchmark().items():
+        print(f"{_frame!r:14} {frames_per_second:12,.0f} frames/s  {1e6 / frames_per_second:6.2f} us/frame")
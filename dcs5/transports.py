@@ -0,0 +1,389 @@
+"""
+This module contains the transports used by the controller to communicate with the board.
+
+Transport is the base class and handles the socket like object `socket`. Its subclasses only implement `connect`:
+    BluetoothClient (dcs5.bluetooth_client): RFCOMM socket.
+    TcpClient: tcp socket, e.g. a serial to tcp bridge or the board simulator.
+    SerialClient: serial device or pseudo-terminal (POSIX only).
+    InProcessClient: one end of a socketpair, the board simulator serving the other end by default.
+"""
+import codecs
+import logging
+import os
+import select
+import selectors
+import socket
+import threading
+from typing import *
+
+from dcs5.logger import wire_logger, WIRE_LOGGING_LEVEL
+
+BOARD_MSG_ENCODING = 'UTF-8'
+BOARD_MSG_DELIMITER = b"\r"
+BOARD_MSG_START = b"%"  # Start of every board message except a few replies (e.g. `HostApp=...`) and `@@@`.
+BUFFER_SIZE = 1024
+MAX_BUFFER_SIZE = 16 * BUFFER_SIZE  # Received data without a delimiter is discarded past this size.
+
+
+class Transport:
+    """Base class of the board clients.
+
+    Subclasses implement `connect` and call `_on_connect` once `socket` is connected.
+    `error_msg` is set and the client is closed when an error occurs. The `disconnected` event
+    is set when the client is closed.
+    """
+    def __init__(self):
+        self.address: str = None
+        self.port: int = None
+        self.socket: socket.socket = None
+        self.default_timeout = 0.1
+        self._is_connected = False
+        self.disconnected = threading.Event()  # Set as soon as the connection is closed or lost.
+        self.disconnected.set()
+        self.error_msg = ""
+        self.errors = {
+            0: 'Socket timeout',
+            1: 'No available ports',
+            2: 'Device not found',
+            3: 'Bluetooth turned off',
+            4: 'Connection broken',
+            5: 'Device Unavailable',
+            6: 'Client closed',
+            99: 'Unknown Error',
+        }
+
+        self._recv_buffer = bytearray(BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._recv_end = 0  # End of the received data in the buffer.
+        self._decoder = codecs.getincrementaldecoder(BOARD_MSG_ENCODING)(errors='replace')
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+
+    @property
+    def socket_timeout(self):
+        return self.socket.gettimeout()
+
+    @property
+    def is_connected(self):
+        return self._is_connected
+
+    def set_timeout(self, value: int):
+        self.socket.settimeout(value)
+
+    def connect(self, address: str = None, timeout: int = None):
+        raise NotImplementedError
+
+    def _on_connect(self):
+        self._is_connected = True
+        self.disconnected.clear()
+        self.socket.settimeout(self.default_timeout)
+        self._selector.register(self.socket, selectors.EVENT_READ)
+        self._recv_end = 0
+        self._decoder.reset()
+
+    def send(self, command: str):
+        try:
+            self.socket.sendall(command.encode(BOARD_MSG_ENCODING))
+        except OSError as err:
+            logging.info(f'OSError on sendall')
+            self.error_msg = self.errors[self._process_os_error_code(err)]
+            self.close()
+
+    def _recv_into_buffer(self) -> int:
+        """Read from the socket into the free end of the receive buffer.
+
+        Returns the number of bytes read. 0 on timeout or error.
+        """
+        if self._recv_end == MAX_BUFFER_SIZE:  # Garbage. Discard it and resync on the next delimiter.
+            logging.error(f'No message delimiter in {MAX_BUFFER_SIZE} bytes received. Buffer discarded.')
+            self._recv_end = 0
+            self._decoder.reset()
+        elif self._recv_end == len(self._recv_buffer):  # No complete frame fits in the buffer. Grow it.
+            self._recv_view.release()
+            self._recv_buffer.extend(bytearray(len(self._recv_buffer)))
+            self._recv_view = memoryview(self._recv_buffer)
+        try:
+            nbytes = self.socket.recv_into(self._recv_view[self._recv_end:])
+        except OSError as err:
+            if (err_code := self._process_os_error_code(err)) != 0:
+                self.error_msg = self.errors[err_code]
+                self.close()
+            return 0
+        if nbytes == 0:  # Only returned when the connection was closed by the board.
+            logging.error('Connection closed by the board.')
+            self.error_msg = self.errors[4]
+            self.close()
+        self._recv_end += nbytes
+        return nbytes
+
+    def receive(self) -> str:
+        """Return everything received, complete frames or not."""
+        self._recv_into_buffer()
+        data = self._decoder.decode(self._recv_view[:self._recv_end])
+        self._recv_end = 0
+        return data
+
+    def receive_frames(self) -> List[str]:
+        """Return all the complete frames received. Incomplete frames are kept in the buffer.
+
+        Frames are `BOARD_MSG_DELIMITER` terminated and only complete frames are decoded.
+        Empty frames and garbage in front of `BOARD_MSG_START` are discarded.
+        """
+        self._recv_into_buffer()
+        frames = []
+        start = 0
+        while (end := self._recv_buffer.find(BOARD_MSG_DELIMITER, start, self._recv_end)) != -1:
+            end += 1
+            if (frame_start := self._recv_buffer.find(BOARD_MSG_START, start, end)) > start:
+                if wire_logger.isEnabledFor(WIRE_LOGGING_LEVEL):
+                    wire_logger.info('Garbage discarded: %r', bytes(self._recv_view[start:frame_start]))
+                start = frame_start
+            if end - start > len(BOARD_MSG_DELIMITER):
+                frames.append(self._decoder.decode(self._recv_view[start:end]))
+            start = end
+        if start > 0:  # Move the incomplete frame at the beginning of the buffer.
+            self._recv_view[:self._recv_end - start] = self._recv_view[start:self._recv_end]
+            self._recv_end -= start
+        return frames
+
+    def clear(self):
+        while self.receive() != "":
+            continue
+        self._decoder.reset()
+
+    def wait_for_data(self, timeout: float = None) -> bool:
+        """Block until the socket is readable or `wakeup` is called.
+
+        Returns True if data can be read from the socket.
+        """
+        is_readable = False
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self._wakeup_reader:
+                self._clear_wakeup()
+            else:
+                is_readable = True
+        return is_readable
+
+    def wakeup(self):
+        """Interrupt a `wait_for_data` call."""
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # Already woken up.
+
+    def _clear_wakeup(self):
+        try:
+            while self._wakeup_reader.recv(BUFFER_SIZE):
+                continue
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        try:
+            self._selector.unregister(self.socket)
+        except (KeyError, ValueError):
+            pass
+        if self.socket is not None:
+            self.socket.close()
+        self._is_connected = False
+        self.disconnected.set()
+
+    def shutdown(self):
+        """Close the client and release the wakeup socketpair and the selector. The client can't be reused."""
+        self.close()
+        self._selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def _process_os_error_code(self, err) -> int:
+        """
+        Parameters
+        ----------
+        err : OS error code.
+
+        Returns
+        -------
+        0: Socket timeout
+        1: Port Unavailable
+        2: Device not Found
+        3: Bluetooth turned off
+        4: Connection broken
+        5: Device Unavailable
+        6: Client closed.
+        99: Unknown Error
+
+        """
+        match err.errno:
+            case None:
+                return 0
+            case 9:
+                logging.error(f'Bad file descriptor. (err{err.errno})')
+                return 6
+            case 16:
+                logging.error(f'Port unavailable. (err{err.errno})')
+                return 1
+            case 22:
+                logging.error(f'Port does not exist. (err{err.errno})')
+                return 1
+            case 77:
+                logging.error(f'Bad file descriptor. (err{err.errno})')
+                return 6
+            case 111:
+                logging.error(f'Device unavailable. (err{err.errno})')
+                return 5
+            case 112:
+                logging.error(f'Device not found. (err{err.errno})')
+                return 2
+            case 104:
+                logging.error(f'Connection broken. (err{err.errno})')
+                return 4
+            case 110:
+                logging.error(f'Connection broken. (err{err.errno})')
+                return 4
+            case 112:
+                logging.error(f'Device not found. (err{err.errno})')
+                return 2
+            case 113:
+                logging.error(f'Bluetooth turned off. (err{err.errno})')
+                return 3
+            case 10022:
+                logging.error(f'Bluetooth turned off. (err{err.errno})')
+                return 3
+            case 10038:
+                logging.error(f'Bad file descriptor. (err{err.errno})')
+                return 6
+            case 10048:
+                logging.error(f'Device unavailable. (Maybe) (err{err.errno})')
+                return 5
+            case 10049:
+                logging.error(f'Port does not exist. (err{err.errno})')
+                return 1
+            case 10050:
+                logging.error(f'Bluetooth turned off. (err{err.errno})')
+                return 3
+            case 10053:
+                logging.error(f'Connection broken. (err{err.errno})')
+                return 4
+            case 10060:
+                logging.error(f'Device not found. (err{err.errno})')
+                return 2
+            case 10064:
+                logging.error(f'Port {self.port} unavailable. (err{err.errno})')
+                return 1
+            case _:
+                logging.error(f'OSError (new): {err.errno}')
+                return 99
+
+
+class TcpClient(Transport):
+    """Tcp socket, `address` is `host:port`."""
+    def connect(self, address: str = None, timeout: int = None):
+        self.address = address
+        timeout = timeout or self.default_timeout
+        host, port = address.rsplit(':', 1)
+        logging.info(f'Attempting to connect to {address}. Timeout: {timeout} seconds')
+        try:
+            self.socket = socket.create_connection((host, int(port)), timeout=timeout)
+        except OSError as err:
+            self.error_msg = self.errors[self._process_os_error_code(err)]
+            return
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.port = int(port)
+        self._on_connect()
+        logging.info(f'Connected to {address}')
+
+
+class _SerialPort:
+    """Socket like interface to a serial device or pseudo-terminal (POSIX only)."""
+    def __init__(self, path: str, baudrate: int):
+        import termios
+        import tty
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+        attributes = termios.tcgetattr(self.fd)
+        attributes[4] = attributes[5] = getattr(termios, f'B{baudrate}')  # input and output speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+        self._timeout: float = None
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def getsockname(self) -> str:
+        return self.path
+
+    def settimeout(self, value: float):
+        if self.fd < 0:
+            raise OSError(9, 'Bad file descriptor')
+        self._timeout = value
+
+    def gettimeout(self) -> float:
+        return self._timeout
+
+    def recv_into(self, buffer: memoryview) -> int:
+        if self._timeout is not None and not select.select([self.fd], [], [], self._timeout)[0]:
+            raise socket.timeout('timed out')
+        return os.readv(self.fd, [buffer])
+
+    def sendall(self, data: bytes):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class SerialClient(Transport):
+    """Serial device or pseudo-terminal, `address` is `path` or `path:baudrate`. POSIX only."""
+    default_baudrate = 115200
+
+    def connect(self, address: str = None, timeout: int = None):
+        self.address = address
+        path, _, baudrate = address.partition(':')
+        logging.info(f'Attempting to open {address}.')
+        try:
+            self.socket = _SerialPort(path, int(baudrate or self.default_baudrate))
+        except ImportError:  # termios
+            logging.error('The serial transport is only supported on POSIX systems.')
+            self.error_msg = 'Serial not supported'
+            return
+        except (ValueError, AttributeError) as err:  # Baudrate not a number or unsupported.
+            logging.error(f'Invalid baudrate: {address}. {err!r}')
+            self.error_msg = 'Invalid baudrate'
+            return
+        except OSError as err:
+            logging.error(f'Could not open {address}. {err!r}')
+            self.error_msg = self.errors[2]
+            return
+        self._on_connect()
+        logging.info(f'Connected to {address}')
+
+
+class InProcessClient(Transport):
+    """One end of a socketpair. By default, the board simulator serves the other end.
+
+    Parameters
+    ----------
+    peer_factory :
+        Called with `address` on connect. Returns the connected socket. Defaults to a
+        Dcs5BoardSimulator of model `address` (xt or micro).
+    """
+    def __init__(self, peer_factory: Callable[[str], socket.socket] = None):
+        super().__init__()
+        self.peer_factory = peer_factory or self._simulator_peer
+
+    @staticmethod
+    def _simulator_peer(model: str = None) -> socket.socket:
+        from dcs5.board_simulator import Dcs5BoardSimulator
+        return Dcs5BoardSimulator(model=model or 'xt').serve_socketpair()
+
+    def connect(self, address: str = None, timeout: int = None):
+        self.address = address
+        self.socket = self.peer_factory(address)
+        self._on_connect()
+        logging.info('Connected to in-process board.')
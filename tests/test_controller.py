@@ -0,0 +1,118 @@
+"""
+Dcs5Controller driven against the board simulator (`InProcessClient` + `Dcs5BoardSimulator`).
+"""
+import json
+import socket
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pyautogui")
+pytest.importorskip("marel_marine_scale_controller")
+
+import dcs5
+from dcs5.board_simulator import Dcs5BoardSimulator
+from dcs5.controller import Dcs5Controller, set_mode_key_backlight_pattern, PRIORITY_INTERACTIVE, COMMAND_TIMEOUT
+
+DEFAULT_CONFIGS_PATH = Path(dcs5.__file__).parent.joinpath("default_configs")
+
+
+def wait_until(predicate, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def simulators():
+    """Simulators served to the controller. The last one is connected."""
+    simulators = []
+    yield simulators
+    for simulator in simulators:
+        simulator.stop()
+
+
+@pytest.fixture
+def controller(tmp_path, simulators):
+    config = json.loads(DEFAULT_CONFIGS_PATH.joinpath("xt_controller_configuration.json").read_text())
+    config["client"]["transport"] = "in_process"
+    config_path = tmp_path.joinpath("controller_configuration.json")
+    config_path.write_text(json.dumps(config))
+
+    controller = Dcs5Controller(
+        str(config_path), str(DEFAULT_CONFIGS_PATH.joinpath("xt_devices_specification.json"))
+    )
+
+    def serve_simulator(model: str) -> socket.socket:
+        simulators.append(Dcs5BoardSimulator(model=model))
+        return simulators[-1].serve_socketpair()
+
+    controller.client.peer_factory = serve_simulator
+    yield controller
+    controller.close_client()
+
+
+def test_connect_syncs_board(controller, simulators):
+    controller.connect()
+
+    assert controller.client.is_connected
+    assert controller.is_sync
+    assert simulators[-1].backlighting_level == controller.persistent_backlight_level
+
+
+def test_coalesced_setting_sent_after_commands_queued_since(controller, simulators):
+    controller.connect()
+    handler = controller.command_handler
+    assert wait_until(lambda: not any(handler.send_queues) and not handler.in_flight)
+
+    with handler.condition:  # Nothing is taken from the send queues while the lock is held.
+        requests = set_mode_key_backlight_pattern(controller, True) + set_mode_key_backlight_pattern(controller, False)
+        queued = [request.command for request in handler.send_queues[PRIORITY_INTERACTIVE]]
+
+    level = controller.persistent_backlight_level
+    key_command = f"&lk,{controller.control_box_parameters.max_backlighting_level},"
+    assert len(queued) == 2
+    assert queued[0].startswith(key_command)
+    assert queued[1] == f"&la,{level}#"
+
+    assert controller.wait_for_commands(requests, timeout=5)
+    assert simulators[-1].commands_received[-2:] == queued
+    assert simulators[-1].backlighting_level == level
+
+
+def test_disconnect_during_sync_cancels_pending_commands(controller):
+    mute_peers = []
+
+    def mute_peer(model: str) -> socket.socket:
+        client_socket, board_socket = socket.socketpair()
+        mute_peers.append(board_socket)
+        return client_socket
+
+    controller.client.peer_factory = mute_peer
+    controller.client.connect("xt")
+    threading.Timer(0.2, lambda: mute_peers[0].close()).start()
+
+    start_time = time.monotonic()
+    controller.sync_board()
+
+    assert time.monotonic() - start_time < COMMAND_TIMEOUT  # Cancelled before the first command timed out.
+    assert not controller.client.is_connected
+    assert not controller.is_sync
+    assert not controller.command_handler.in_flight
+    assert not any(controller.command_handler.send_queues)
+    assert controller.command_handler.queue_command("&q#", "%q#").error == "cancelled"
+
+
+def test_reconnects_and_resyncs_after_connection_lost(controller, simulators):
+    controller.connect()
+    assert controller.is_sync
+
+    simulators[-1].stop()
+
+    assert wait_until(lambda: len(simulators) == 2 and controller.client.is_connected and controller.is_sync)
+    assert simulators[-1].backlighting_level == controller.persistent_backlight_level
@@ -0,0 +1,19 @@
+import pytest
+
+from dcs5.devices_specifications import Board
+
+
+@pytest.mark.parametrize("position, index", [
+    (-1, None),
+    (16, None),  # Before the first key. Truncation toward zero mapped it to the first key.
+    (24, None),
+    (25, 0),
+    (34, 0),
+    (35, 1),
+    (54, 2),
+    (55, None),  # End of the last key.
+    (56, None),
+])
+def test_key_index(position, index):
+    board = Board(number_of_keys=3, key_to_mm_ratio=10, zero=30, detection_range=5, keys_layout={})
+    assert board.key_index(position) == index